@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+from common import req_header
+import asyncio
+import httpx
+import metrics
+import time
+import weakref
+
+try:
+    import h2
+    _has_http2 = True
+except ImportError:
+    _has_http2 = False
+
+
+class AsyncSession():
+    """asyncio counterpart of `common.session()`: one pooled keep-alive client,
+    speaking HTTP/2 to servers that negotiate it when the `h2` package is
+    installed."""
+
+    def __init__(self, max_connections=20, max_keepalive=10, http2=None):
+        if http2 is None:
+            http2 = _has_http2
+        limits = httpx.Limits(max_connections=max_connections,
+            max_keepalive_connections=max_keepalive)
+        self.client = httpx.AsyncClient(headers=req_header, http2=http2,
+            limits=limits, follow_redirects=True)
+
+    async def get(self, url, **kwargs):
+        start = time.perf_counter()
+        resp = await self.client.get(url, **kwargs)
+        metrics.record_request(str(resp.url), resp.status_code, time.perf_counter() - start,
+            len(resp.content))
+        return resp
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+# An AsyncClient is bound to the event loop it was first used on, so the
+# shared session is kept per loop.
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_session():
+    loop = asyncio.get_running_loop()
+    if loop not in _sessions:
+        _sessions[loop] = AsyncSession()
+    return _sessions[loop]
+
+
+async def close_session():
+    loop = asyncio.get_running_loop()
+    if loop in _sessions:
+        await _sessions.pop(loop).close()
+
+
+def run(coro):
+    """Run `coro` to completion from synchronous code, closing the shared
+    session of the temporary event loop afterwards."""
+    async def wrapper():
+        try:
+            return await coro
+        finally:
+            await close_session()
+    return asyncio.run(wrapper())
@@ -1,8 +1,14 @@
 #!/usr/bin/env python3
 
-from common import sess, MyHTMLParser
+from common import session, MyHTMLParser, Throughput, iter_response, decode_chunks, feed_chunks
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from html import unescape
 import getopt
+import itertools
 import json
+import metrics
+import re
+import shlex
 import sys
 
 amenities_list = {
@@ -32,21 +38,213 @@ amenities_list = {
 }
 
 
+page_range_pat = re.compile(r'Page\s+\d+\s+of\s+(\d+)')
+
+# What AptSearchPageScanner looks for in the raw bytes of a page: comments
+# and scripts or styles (skipped, as HTMLParser does not look for tags in
+# them), ld+json blocks and the page range span
+_ldjson_start = re.compile(rb'<script\b[^>]*\btype\s*=\s*["\']?application/ld\+json\b[^>]*>')
+_page_range_start = re.compile(rb'<span\b[^>]*\bclass\s*=\s*["\']?[^"\'>]*(?<![\w-])pageRange(?![\w-])[^>]*>')
+_scan_token = re.compile(rb'<!--|<(script|style)\b[^>]*>|' + _page_range_start.pattern)
+# Where HTMLParser ends the content of a script or style
+_element_end = {
+    b'script': re.compile(rb'</script(?=[\t\n\r\f />])'),
+    b'style': re.compile(rb'</style(?=[\t\n\r\f />])')
+}
+
+
 class AptSearchPageParser(MyHTMLParser):
 
-    def __init__(self):
+    def __init__(self, stop_early=False, page_count=False):
+        """stop_early: stop parsing after the first ld+json listing block
+        page_count: also find the number of result pages before stopping"""
         super(AptSearchPageParser, self).__init__()
         self.apartments = []
+        self.stop_early = stop_early
+        self.page_count = page_count
+        self.pages = None
+        # The content of a script may be delivered in several pieces
+        self.script_data = None
+        self.page_range = None
+
+    def on_starttag(self, tag):
+        if str(tag) == 'script' and tag.attr_eq('type', 'application/ld+json'):
+            self.script_data = []
+        elif str(tag) == 'span' and 'pageRange' in (tag.attrs.get('class') or '').split():
+            self.page_range = []
+
+    def on_endtag(self, tag):
+        if self.page_range is not None and str(tag) == 'span':
+            match = page_range_pat.search(''.join(self.page_range))
+            self.page_range = None
+            if match is not None:
+                self.pages = int(match.group(1))
+                self._check_done()
+        if self.script_data is None or str(tag) != 'script':
+            return
+        obj = json.loads(''.join(self.script_data))
+        self.script_data = None
+        if isinstance(obj, list):
+            for item in obj:
+                self.apartments.append(item)
+            self._check_done()
+
+    def _check_done(self):
+        if not self.stop_early or not self.apartments:
+            return
+        if self.page_count and self.pages is None:
+            return
+        self.done = True
 
     def on_data(self, data):
-        if len(self.tags) == 0:
-            return
-        toptag = self.tags[-1]
-        if str(toptag) == 'script' and toptag.attr_eq('type', 'application/ld+json'):
-            obj = json.loads(data)
-            if isinstance(obj, list):
-                for item in obj:
-                    self.apartments.append(item)
+        if self.script_data is not None:
+            self.script_data.append(data)
+        if self.page_range is not None:
+            self.page_range.append(data)
+
+
+class UnexpectedPage(Exception):
+    pass
+
+
+class AptSearchPageScanner():
+    """Fast path of AptSearchPageParser: finds the ld+json blocks and the
+    "Page 1 of N" span in the raw bytes of a page with byte patterns, and
+    only copies out and decodes those, instead of tokenizing the whole
+    document into Tags. Like HTMLParser, it skips comments and the content
+    of other scripts and styles. It has the attributes of
+    AptSearchPageParser and takes the same stop_early and page_count.
+
+    A page fed in one piece is scanned in place; a page fed in chunks is
+    kept until the scanner is done with it. feed() and close() raise
+    UnexpectedPage when the page is not laid out as expected, e.g. it has no
+    ld+json block or one that is not JSON (see scan_search_page())."""
+
+    def __init__(self, stop_early=False, page_count=False, encoding='utf-8'):
+        if '<script'.encode(encoding, 'replace') != b'<script':
+            raise UnexpectedPage('Cannot scan %s' % encoding)
+        self.apartments = []
+        self.stop_early = stop_early
+        self.page_count = page_count
+        self.encoding = encoding
+        self.pages = None
+        self.done = False
+        self.buf = b''
+        self.blocks = 0
+        # Where the next tag is looked for, and where the open block starts
+        self.pos = 0
+        self.block = None
+
+    _check_done = AptSearchPageParser._check_done
+
+    def feed(self, data):
+        if not self.buf:
+            self.buf = data
+        else:
+            if not isinstance(self.buf, bytearray):
+                self.buf = bytearray(self.buf)
+            self.buf += data
+        self._scan(final=False)
+
+    def close(self):
+        self._scan(final=True)
+        if self.block is not None:
+            raise UnexpectedPage('Unterminated ld+json block')
+        if not self.blocks:
+            raise UnexpectedPage('No ld+json block')
+
+    def _resume_at(self, pos):
+        # A tag cut off at the end of the buffer starts at its last '<'
+        last = self.buf.rfind(b'<', pos)
+        return last if last >= 0 else len(self.buf)
+
+    def _scan(self, final):
+        buf = self.buf
+        while not self.done:
+            if self.block is not None:
+                match = _element_end[b'script'].search(buf, self.pos)
+                if match is None:
+                    self.pos = self._resume_at(self.pos)
+                    return
+                self._ldjson(buf[self.block:match.start()])
+                self.block = None
+                self.pos = match.end()
+                continue
+            match = _scan_token.search(buf, self.pos)
+            if match is None:
+                self.pos = self._resume_at(self.pos)
+                return
+            if match.group(0) == b'<!--':
+                # Nothing in a comment counts, ld+json blocks included
+                end = buf.find(b'-->', match.end())
+                if end < 0:
+                    self.pos = match.start()
+                    return
+                self.pos = end + len(b'-->')
+            elif match.group(1) is not None:
+                if _ldjson_start.match(buf, match.start()):
+                    self.block = self.pos = match.end()
+                    continue
+                end = _element_end[match.group(1)].search(buf, match.end())
+                if end is None:
+                    self.pos = match.start()
+                    return
+                self.pos = end.end()
+            else:
+                end = buf.find(b'<', match.end())
+                if end < 0 or (len(buf) - end < len(b'</span') and not final):
+                    self.pos = match.start()
+                    return
+                if not buf.startswith(b'</span', end):
+                    raise UnexpectedPage('Markup in the page range')
+                self.pos = end
+                self._page_range(buf[match.end():end])
+
+    def _ldjson(self, content):
+        try:
+            obj = json.loads(content.decode(self.encoding))
+        except ValueError as e:
+            raise UnexpectedPage('ld+json block is not JSON: %s' % e)
+        self.blocks += 1
+        if isinstance(obj, list):
+            self.apartments.extend(obj)
+            self._check_done()
+
+    def _page_range(self, content):
+        match = page_range_pat.search(unescape(content.decode(self.encoding)))
+        if match is not None:
+            self.pages = int(match.group(1))
+            self._check_done()
+
+
+def scan_search_page(chunks, encoding='utf-8', stop_early=False, page_count=False):
+    """Parse a search results page, given as bytes or as an iterable of byte
+    chunks (e.g. `common.iter_response(resp, decode=False)`), with an
+    AptSearchPageScanner, or with an AptSearchPageParser when the page is
+    not laid out the way the scanner expects. Returns the one that did."""
+    source = chunks
+    if isinstance(chunks, (bytes, bytearray)):
+        chunks = (chunks,)
+    chunks = iter(chunks)
+    scanner = None
+    try:
+        scanner = AptSearchPageScanner(stop_early, page_count, encoding)
+        for chunk in chunks:
+            scanner.feed(chunk)
+            if scanner.done:
+                break
+        else:
+            scanner.close()
+        metrics.count('search_scan', result='scanned')
+        return scanner
+    except UnexpectedPage:
+        metrics.count('search_scan', result='fallback')
+        seen = (bytes(scanner.buf),) if scanner is not None else ()
+        parser = AptSearchPageParser(stop_early, page_count)
+        return feed_chunks(parser, decode_chunks(itertools.chain(seen, chunks), encoding))
+    finally:
+        if hasattr(source, 'close'):
+            source.close()
 
 
 def specs_bedrooms(specs, min_beds, max_beds, studio):
@@ -121,7 +319,7 @@ def findval(obj, key, default=None):
         return default
 
 
-def find_apartments(location, **kwargs):
+def search_url(location, **kwargs):
     url = 'https://www.apartments.com/'
     url += apt_location(location)
     url += apt_spec(min_beds=findval(kwargs, 'min_beds'), max_beds=findval(kwargs, 'max_beds'),
@@ -130,11 +328,10 @@ def find_apartments(location, **kwargs):
         dog=findval(kwargs, 'dog', False)
     )
     url += apt_amenities(findval(kwargs, 'amenities', []))
+    return url
 
-    resp = sess.get(url)
 
-    search_page_parser = AptSearchPageParser()
-    search_page_parser.feed(resp.text)
+def search_results(search_page_parser):
     res = []
     for apt in search_page_parser.apartments:
         vloc, ploc = apt['location']
@@ -150,9 +347,145 @@ def find_apartments(location, **kwargs):
     return res
 
 
-def help():
-    print('Usage: %s [filters...] <location>' % sys.argv[0])
-    print('')
+def page_url(url, page):
+    if page == 1:
+        return url
+    return '%s/%d/' % (url.rstrip('/'), page)
+
+
+def fetch_search_page(url, stream=False, page_count=False):
+    """Fetch and parse one search results page; returns the parser (see
+    scan_search_page())."""
+    if not stream:
+        with metrics.timer('search.fetch'):
+            resp = session().get(url)
+        with metrics.timer('search.parse'):
+            return scan_search_page(resp.content, resp.encoding or 'utf-8', page_count=page_count)
+    with metrics.timer('search.fetch'):
+        resp = session().get(url, stream=True)
+    # Includes waiting for the rest of the page
+    with metrics.timer('search.parse', mode='stream'):
+        return scan_search_page(iter_response(resp, decode=False), resp.encoding or 'utf-8',
+            stop_early=True, page_count=page_count)
+
+
+def find_apartments(location, stream=False, all_pages=False, **kwargs):
+    """stream: parse the page as it is downloaded and stop reading it once
+    the listings have been found
+    all_pages: return the listings of every result page, not only the first"""
+    if all_pages:
+        return list(iter_apartments(location, stream=stream, **kwargs))
+    return search_results(fetch_search_page(search_url(location, **kwargs), stream))
+
+
+async def find_apartments_async(location, session=None, **kwargs):
+    """Listings of the first result page of a search, fetched with an
+    aio.AsyncSession (by default the shared one of the running loop)."""
+    if session is None:
+        import aio
+        session = aio.get_session()
+    resp = await session.get(search_url(location, **kwargs))
+    resp.raise_for_status()
+    return search_results(scan_search_page(resp.content, resp.encoding or 'utf-8'))
+
+
+def iter_apartments(location, stream=True, max_workers=4, max_pages=None, checkpoint=None, **kwargs):
+    """Yield the summaries of every result page of a search, see
+    search_all()."""
+    return search_all([(location, kwargs)], stream=stream, max_workers=max_workers,
+        max_pages=max_pages, checkpoint=checkpoint)
+
+
+def search_all(queries, stream=True, max_workers=4, max_pages=None, stats=None, checkpoint=None):
+    """Run many searches, given as (location, criteria) pairs, on one pool
+    of `max_workers` threads and yield the summary of every listing found,
+    each listing URL only once, as the result pages arrive.
+
+    The first page of a search tells how many result pages it has; the
+    others are then queued behind the pages of the other searches.
+    stats: a common.Throughput counting 'pages' and 'listings'.
+    checkpoint: a checkpoint.Checkpoint recording the result pages still to
+    fetch and the listings found. Searching with a checkpoint of an earlier
+    run only fetches the pages that run did not, and only yields listings it
+    had not found (see Checkpoint.pending_listings() for those)."""
+    seen = set()
+    if checkpoint is not None:
+        seen.update(checkpoint.listing_urls())
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        if checkpoint is None:
+            for location, criteria in queries:
+                url = search_url(location, **criteria)
+                pending[executor.submit(fetch_search_page, url, stream, True)] = (url, 1)
+        else:
+            for location, criteria in queries:
+                checkpoint.add_search(search_url(location, **criteria))
+            for url, page in checkpoint.pending_search_pages():
+                pending[executor.submit(fetch_search_page, page_url(url, page), stream, page == 1)] = \
+                    (url, page)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, page = pending.pop(future)
+                try:
+                    parser = future.result()
+                except Exception as e:
+                    metrics.count('failures', stage='search')
+                    print('Failed to search %s: %r' % (page_url(url, page), e), file=sys.stderr)
+                    continue
+                if stats is not None:
+                    stats.add('pages')
+                more = ()
+                if page == 1:
+                    pages = parser.pages or 1
+                    if max_pages is not None:
+                        pages = min(pages, max_pages)
+                    more = range(2, pages + 1)
+                summaries = search_results(parser)
+                if checkpoint is not None:
+                    checkpoint.search_page_done(url, page, [apt for apt in summaries if apt['url'] not in seen],
+                        more)
+                for n in more:
+                    pending[executor.submit(fetch_search_page, page_url(url, n), stream)] = (url, n)
+                for apt in summaries:
+                    if apt['url'] in seen:
+                        continue
+                    seen.add(apt['url'])
+                    if stats is not None:
+                        stats.add('listings')
+                    yield apt
+
+
+criteria_shortopts = 'cdb:B:r:R:a:'
+criteria_longopts = ['min-beds=', 'max-beds=', 'min-rent=', 'max-rent=', 'cat', 'dog', 'amenities=']
+
+
+def parse_criteria(k, v, criteria):
+    """Apply one getopt (option, value) pair to `criteria`. Returns False if
+    the option is not a search filter."""
+    if k in ('-b', '--min-beds'):
+        criteria['min_beds'] = int(v)
+    elif k in ('-B', '--max-beds'):
+        if v.lower() == 'studio':
+            criteria['studio'] = True
+        else:
+            criteria['max_beds'] = int(v)
+    elif k in ('-r', '--min-rent'):
+        criteria['min_rent'] = int(v)
+    elif k in ('-R', '--max-rent'):
+        criteria['max_rent'] = int(v)
+    elif k in ('-c', '--cat'):
+        criteria['cat'] = True
+    elif k in ('-d', '--dog'):
+        criteria['dog'] = True
+    elif k in ('-a', '--amenities'):
+        criteria['amenities'] = v.split(',')
+    else:
+        return False
+    return True
+
+
+def help_filters():
     print('Filters:')
     print('  -b, --min-beds <1-4>: Minimum number of bedrooms. (1-4)')
     print('  -B, --max-beds <1-3 | studio>: Maximum number of bedrooms. (1-3 or "studio")')
@@ -165,34 +498,108 @@ def help():
     for key, value in amenities_list.items():
         print('    %s - %s' % (key, value[0]))
 
+
+def parse_query(line):
+    """Parse one query of a batch file: "[filters...] <location>", with the
+    same filter options as the command line. Returns (location, criteria)."""
+    opts, args = getopt.getopt(shlex.split(line), criteria_shortopts, criteria_longopts)
+    criteria = {}
+    for k, v in opts:
+        parse_criteria(k, v, criteria)
+    location = ' '.join(args)
+    if not location:
+        raise ValueError('No location in query: %s' % line)
+    return location, criteria
+
+
+def read_queries(path):
+    queries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                queries.append(parse_query(line))
+    return queries
+
+
+def help_pages():
+    print('  --all-pages: Search every result page, not only the first')
+
+
+def help_cache():
+    print('  --cache: Keep responses in the on-disk HTTP cache')
+    print('  --offline: Answer every request from the on-disk HTTP cache only')
+
+
+def help_watch():
+    print('  --watch <N>: Keep running and repeat every N seconds, printing each new or changed')
+    print('    listing as a JSON line {"event": "new" | "changed", "url": ..., "listing": ...}')
+    print('    (stop with Ctrl-C)')
+
+
+def help_metrics():
+    print('  --metrics <file>: Append the timers and counters of the run to <file> as JSON lines')
+    print('    ("-" for stderr)')
+    print('  --metrics-port <N>: Serve the timers and counters in the Prometheus text format on port N')
+
+
+def help():
+    print('Usage: %s [options] [filters...] <location>' % sys.argv[0])
+    print('       %s [options] --batch <file>' % sys.argv[0])
+    print('')
+    print('Options:')
+    help_pages()
+    help_cache()
+    print('  --batch <file>: Run every query of <file>, one "[filters...] <location>" per line,')
+    print('    and list each listing once')
+    print('  --details: Fetch the details of every listing found, printed as JSON lines')
+    print('  --ndjson: Print each listing found as a line of JSON')
+    help_watch()
+    help_metrics()
+    print('')
+    help_filters()
+
+
 if __name__ == '__main__':
-    longargs = ['min-beds=', 'max-beds=', 'min-rent=', 'max-rent=', 'cat', 'dog', 'amenities=']
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'cdhb:B:r:R:a:', longargs)
+        opts, args = getopt.getopt(sys.argv[1:], 'h' + criteria_shortopts,
+            ['all-pages', 'cache', 'offline', 'batch=', 'details', 'ndjson', 'watch=', 'metrics=',
+            'metrics-port='] + criteria_longopts)
     except getopt.GetoptError as e:
         print(e)
         help()
         exit(1)
 
     criteria = {}
+    use_cache = False
+    offline = False
+    all_pages = False
+    batch = None
+    details = False
+    ndjson = False
+    watch_interval = None
+    metrics_file = None
     for k, v in opts:
-        if k in ('-b', '--min-beds'):
-            criteria['min_beds'] = int(v)
-        elif k in ('-B', '--max-beds'):
-            if v.lower() == 'studio':
-                criteria['studio'] = True
-            else:
-                criteria['max_beds'] = int(v)
-        elif k in ('-r', '--min-rent'):
-            criteria['min_rent'] = int(v)
-        elif k in ('-R', '--max-rent'):
-            criteria['max_rent'] = int(v)
-        elif k in ('-c', '--cat'):
-            criteria['cat'] = True
-        elif k in ('-d', '--dog'):
-            criteria['dog'] = True
-        elif k in ('-a', '--amenities'):
-            criteria['amenities'] = v.split(',')
+        if parse_criteria(k, v, criteria):
+            continue
+        elif k == '--all-pages':
+            all_pages = True
+        elif k == '--batch':
+            batch = v
+        elif k == '--details':
+            details = True
+        elif k == '--ndjson':
+            ndjson = True
+        elif k == '--watch':
+            watch_interval = float(v)
+        elif k == '--cache':
+            use_cache = True
+        elif k == '--offline':
+            offline = True
+        elif k == '--metrics':
+            metrics_file = v
+        elif k == '--metrics-port':
+            metrics.registry.serve(int(v))
         elif k == '-h':
             help()
             exit(0)
@@ -201,16 +608,50 @@ if __name__ == '__main__':
             help()
             exit(1)
 
-    location = ' '.join(args)
-    if not location:
-        help()
-        exit(1)
+    if batch is not None:
+        queries = read_queries(batch)
+    else:
+        location = ' '.join(args)
+        if not location:
+            help()
+            exit(1)
+        queries = [(location, criteria)]
 
-    apts = find_apartments(location, **criteria)
-    for apt in apts:
-        print(apt['name'])
-        print(apt['street'])
-        print('%s, %s, %s' % (apt['city'], apt['zipcode'], apt['state']))
-        print(apt['url'])
-        print('')
+    if use_cache or offline:
+        from cache import install_cache
+        install_cache(offline=offline)
 
+    stats = Throughput()
+    if watch_interval is not None:
+        from watch import Watcher, write_ndjson
+        watcher = Watcher(queries, interval=watch_interval, max_pages=None if all_pages else 1,
+            details=details)
+        try:
+            write_ndjson(watcher.run())
+        except KeyboardInterrupt:
+            pass
+        apts = ()
+    elif batch is not None or all_pages:
+        apts = search_all(queries, max_pages=None if all_pages else 1, stats=stats)
+    else:
+        apts = find_apartments(location, **criteria)
+    if details and watch_interval is None:
+        from crawler import crawl
+        for page in crawl(apts, stats=stats):
+            print(json.dumps(page.apt), flush=True)
+    elif ndjson:
+        for apt in apts:
+            print(json.dumps(apt), flush=True)
+    else:
+        for apt in apts:
+            print(apt['name'])
+            print(apt['street'])
+            print('%s, %s, %s' % (apt['city'], apt['zipcode'], apt['state']))
+            print(apt['url'])
+            print('', flush=True)
+    if stats.counts:
+        stats.report()
+    if details:
+        print(metrics.registry.summary(), file=sys.stderr)
+    if metrics_file is not None:
+        metrics.save(metrics_file)
@@ -1,35 +1,390 @@
 #!/usr/bin/env python3
 
-from bs4 import BeautifulSoup
-from common import sess
-from time import sleep
+from common import session, MyHTMLParser, iter_response, feed_chunks
+from concurrent.futures import ThreadPoolExecutor
 
-import bs4
-import google
+import getopt
 import json
-import locale
-import random
-import re
+import metrics
+import parsing
+import reviews
 import sys
+import threading
+import time
 
-locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
-datepat = re.compile(r'(Now|Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Nov|Dec)(\w*\. \d+)?')
-pricepat = re.compile('\$([0-9,]+)')
+
+class AptDetailPageParser(MyHTMLParser):
+    """Single-pass extractor for a listing detail page. Collects the raw text
+    of every node the `ApartmentPage._extract_*` methods look at, with the same
+    find/find_all semantics, without building a tree. ApartmentPage turns the
+    collected text into the `apt` dict."""
+
+    # Sections that are a single node on the page, so parsing can stop once
+    # they have all been closed. 'overall' and 'floorplans' are lists that
+    # need the whole page.
+    single_sections = set(['name', 'address', 'description', 'contact', 'amenities'])
+
+    def __init__(self, sections=None):
+        """sections: names of the sections to collect (see
+        ApartmentPage.sections), or None for all of them"""
+        super(AptDetailPageParser, self).__init__()
+        if sections is None:
+            sections = ApartmentPage.sections
+        self.sections = set(sections)
+        self.pending = set(sections)
+        # Per open tag, the actions to run when it is closed
+        self.frames = []
+        # Text buffers of the nodes being captured
+        self.buffers = []
+        self.page = {}
+        self.address = None
+        self.overall = []
+        self.models = []
+        self.description = None
+        self.contact = None
+        self.amenities = None
+        # Currently open scopes
+        self._addr = None
+        self._statezip = None
+        self._overall = None
+        self._model = None
+        self._details = None
+        self._leasing = None
+        self._unit = None
+        self._desc = None
+        self._feature = None
+        self._contact = None
+        self._phone = None
+        self._phone_a = None
+        self._amenity_sect = None
+        self._categories = []
+        self._spec = None
+        self._spec_info = None
+
+    def _end_capture(self, buf):
+        for i in range(len(self.buffers) - 1, -1, -1):
+            if self.buffers[i] is buf:
+                del self.buffers[i]
+                return
+
+    def _capture(self, frame, callback):
+        buf = []
+        self.buffers.append(buf)
+
+        def done():
+            self._end_capture(buf)
+            callback(''.join(buf))
+        frame.append(done)
+
+    def _capture_first(self, frame, holder, key):
+        """Like `find(...).text`: only the first matching node is captured."""
+        if key in holder:
+            return
+        holder[key] = None
+        self._capture(frame, lambda text: holder.__setitem__(key, text))
+
+    def _capture_all(self, frame, items):
+        """Like `find_all(...)`: texts are kept in start tag order."""
+        index = len(items)
+        items.append(None)
+        self._capture(frame, lambda text: items.__setitem__(index, text))
+
+    def _scope(self, frame, attr, value):
+        setattr(self, attr, value)
+        frame.append(lambda: setattr(self, attr, None))
+
+    def _section_end(self, frame, section):
+        def done():
+            self.pending.discard(section)
+            self.done = not self.pending
+        frame.append(done)
+
+    def on_starttag(self, tag):
+        frame = []
+        self.frames.append(frame)
+        name = tag.name
+        classes = tag.attrs.get('class')
+        classes = classes.split() if classes else ()
+
+        sections = self.sections
+
+        if name == 'h1' and tag.attr_eq('id', 'propertyName') and 'name' in sections:
+            if 'name' not in self.page:
+                self._capture_first(frame, self.page, 'name')
+                self._section_end(frame, 'name')
+
+        # address
+        if self._addr is not None:
+            if name == 'span' and len(self._addr['spans']) < 2:
+                self._capture_all(frame, self._addr['spans'])
+            if self._statezip is not None and name == 'span':
+                self._capture_all(frame, self._statezip)
+            if name == 'span' and 'stateZipContainer' in classes and 'statezip' not in self._addr:
+                self._addr['statezip'] = []
+                self._scope(frame, '_statezip', self._addr['statezip'])
+        elif name == 'div' and 'propertyAddressContainer' in classes and self.address is None \
+                and 'address' in sections:
+            self.address = {'spans': []}
+            self._section_end(frame, 'address')
+            self._scope(frame, '_addr', self.address)
+
+        # overall rent, bedrooms, bathrooms and area
+        if self._overall is not None:
+            if 'rentInfoLabel' in classes:
+                self._capture_first(frame, self._overall, 'label')
+            if 'rentInfoDetail' in classes:
+                self._capture_first(frame, self._overall, 'detail')
+        elif name == 'div' and 'priceBedRangeInfoInnerContainer' in classes and 'overall' in sections:
+            self.overall.append({})
+            self._scope(frame, '_overall', self.overall[-1])
+
+        # floor plans
+        if self._model is not None:
+            model = self._model
+            if name == 'span':
+                if 'modelName' in classes:
+                    self._capture_first(frame, model, 'name')
+                if 'rentLabel' in classes:
+                    self._capture_first(frame, model, 'rent')
+                if self._details is not None:
+                    self._capture_all(frame, self._details)
+                if 'detailsTextWrapper' in classes and 'details' not in model:
+                    model['details'] = []
+                    self._scope(frame, '_details', model['details'])
+                if 'amenity' in classes:
+                    self._capture_all(frame, model['amenities'])
+                if self._leasing is not None:
+                    self._capture_all(frame, self._leasing)
+                if 'leaseDepositLabel' in classes and 'leasing' not in model:
+                    model['leasing'] = []
+                    self._scope(frame, '_leasing', model['leasing'])
+                if 'availabilityInfo' in classes:
+                    self._capture_first(frame, model, 'avail')
+            if self._unit is not None:
+                if name == 'div' and 'unitColumn' in classes:
+                    self._capture_first(frame, self._unit, 'unit')
+                if name == 'div' and 'pricingColumn' in classes:
+                    self._capture_first(frame, self._unit, 'price')
+                if name == 'span' and 'dateAvailable' in classes:
+                    self._capture_first(frame, self._unit, 'date')
+            elif name == 'li' and 'unitContainer' in classes:
+                model['units'].append({})
+                self._scope(frame, '_unit', model['units'][-1])
+        elif name == 'div' and 'pricingGridItem' in classes and 'floorplans' in sections:
+            self.models.append({'amenities': [], 'units': []})
+            self._scope(frame, '_model', self.models[-1])
+
+        # description
+        if self._desc is not None:
+            if name == 'p':
+                self._capture_all(frame, self._desc['about'])
+            if self._feature is not None and name == 'span':
+                self._capture_first(frame, self._feature, 'span')
+            if name == 'li' and 'uniqueAmenity' in classes and self._feature is None:
+                self._desc['features'].append({})
+                self._scope(frame, '_feature', self._desc['features'][-1])
+        elif name == 'section' and 'descriptionSection' in classes and self.description is None \
+                and 'description' in sections:
+            self.description = {'about': [], 'features': []}
+            self._section_end(frame, 'description')
+            self._scope(frame, '_desc', self.description)
+
+        # contact
+        if self._contact is not None:
+            if self._phone_a is not None and name == 'span':
+                self._capture_first(frame, self._contact, 'tel')
+            if self._phone is not None and name == 'a' and 'phone_a' not in self._contact:
+                self._contact['phone_a'] = True
+                self._scope(frame, '_phone_a', True)
+            if name == 'div' and 'phoneNumber' in classes and 'phone' not in self._contact:
+                self._contact['phone'] = True
+                self._scope(frame, '_phone', True)
+            if name == 'a' and 'propertyWebsiteLink' in classes and 'website' not in self._contact:
+                self._contact['website'] = tag.attrs.get('href')
+        elif name == 'section' and tag.attr_eq('id', 'officeHoursSection') and self.contact is None \
+                and 'contact' in sections:
+            self.contact = {}
+            self._section_end(frame, 'contact')
+            self._scope(frame, '_contact', self.contact)
+
+        # amenities
+        if self._amenity_sect is not None:
+            depth = len(self.tags) - 1
+            for cat in self._categories:
+                if depth != cat['depth'] or self.tags[depth - 1] is not cat['parent']:
+                    continue
+                # a sibling following the category title
+                if name == 'h2':
+                    self._categories.remove(cat)
+                elif name == 'div' and 'spec' in classes:
+                    self._scope(frame, '_spec', cat)
+                break
+            if self._spec_info is not None and name == 'span':
+                self._capture_first(frame, self._spec_info, 'span')
+            if self._spec is not None and name == 'li' and 'specInfo' in classes and self._spec_info is None:
+                self._spec['items'].append({})
+                self._scope(frame, '_spec_info', self._spec['items'][-1])
+            if name == 'h2' and 'sectionTitle' in classes:
+                cat = {'items': [], 'depth': depth, 'parent': self.tags[depth - 1]}
+                self.amenities.append(cat)
+                self._categories.append(cat)
+                self._capture_first(frame, cat, 'title')
+        elif name == 'section' and 'amenitiesSection' in classes and self.amenities is None \
+                and 'amenities' in sections:
+            self.amenities = []
+            self._section_end(frame, 'amenities')
+            self._scope(frame, '_amenity_sect', self.amenities)
+            frame.append(self._categories.clear)
+
+    def on_endtag(self, tag):
+        for action in self.frames.pop():
+            action()
+
+    def on_startendtag(self, tag):
+        self.tags.append(tag)
+        self.on_starttag(tag)
+        self.on_endtag(tag)
+        self.tags.pop()
+
+    def feed(self, data):
+        super(AptDetailPageParser, self).feed(data.replace('–', '-'))
+
+    def on_data(self, data):
+        if not self.buffers:
+            return
+        if len(self.tags) > 0 and self.tags[-1].name in ('script', 'style'):
+            return
+        for buf in self.buffers:
+            buf.append(data)
+
+
+_enrichment_executor = None
+_enrichment_lock = threading.Lock()
+
+
+def enrichment_executor():
+    global _enrichment_executor
+    with _enrichment_lock:
+        if _enrichment_executor is None:
+            _enrichment_executor = ThreadPoolExecutor(max_workers=8)
+        return _enrichment_executor
 
 
 class ApartmentPage():
 
-    def __init__(self, html_text, apt_summary):
-        self.soup = BeautifulSoup(html_text.replace('–', '-'), 'html.parser')
+    sections = ('name', 'address', 'overall', 'floorplans', 'description', 'contact', 'amenities')
+
+    # Method of the soup engine extracting each section
+    extractors = {
+        'name': '_extract_apt_name',
+        'address': '_extract_apt_address',
+        'overall': '_extract_apt_overall',
+        'floorplans': '_extract_floor_plans',
+        'description': '_extract_description',
+        'contact': '_extract_contact',
+        'amenities': '_extract_amenities'
+    }
+
+    # Enrichment stages: data from other sources attached to the listing,
+    # mapped to the method that adds it to `apt`
+    enrichers = {
+        'reviews': '_enrich_reviews',
+        'geo': '_enrich_geo'
+    }
+
+    def __init__(self, html_text, apt_summary, engine='soup', sections=None, known_reviews=None,
+            enrich=('reviews',), defer=False):
+        """html_text: the page, or an iterable of text chunks of it (e.g.
+        `common.iter_response()` of a streamed response)
+        engine: 'soup' to extract from a BeautifulSoup tree, or 'stream' to
+        collect everything in a single AptDetailPageParser pass, reading the
+        chunks as they arrive. Both produce the same `apt` dict.
+        sections: only extract these sections (default: all). The stream
+        engine stops reading the page once they have been found.
+        known_reviews: reviews of the listing collected earlier; only newer
+        ones are fetched from Google.
+        enrich: enrichment stages to run (see `enrichers`), () for none.
+        defer: return as soon as the page is parsed and run the enrichment
+        stages in the background; see wait(), enriched() and when_enriched()."""
         self.apt = apt_summary
-        self._extract_apt_name()
-        self._extract_apt_address()
-        self._extract_apt_overall()
-        self._extract_floor_plans()
-        self._extract_description()
-        self._extract_contact()
-        self._extract_amenities()
-        self._get_google_reviews()
+        self.known_reviews = known_reviews
+        self.enrichment = {}
+        if sections is None:
+            sections = self.sections
+        if isinstance(html_text, str):
+            html_text = (html_text,)
+        if engine == 'stream':
+            self.soup = None
+            # Includes waiting for the rest of a streamed page
+            with metrics.timer('detail.parse', engine='stream'):
+                parser = feed_chunks(AptDetailPageParser(sections), html_text)
+            with metrics.timer('detail.extract', engine='stream'):
+                self._apply_parsed(parser)
+        elif engine == 'soup':
+            # bs4 is only imported by the engine that needs it
+            from bs4 import BeautifulSoup
+            with metrics.timer('detail.parse', engine='soup'):
+                self.soup = BeautifulSoup(''.join(html_text).replace('–', '-'), 'html.parser')
+            for section in self.sections:
+                if section in sections:
+                    with metrics.timer('detail.extract', engine='soup', section=section):
+                        getattr(self, self.extractors[section])()
+        else:
+            raise ValueError('Unknown extraction engine: %s' % engine)
+        self.enrich(enrich, defer)
+
+    @classmethod
+    def from_record(cls, apt):
+        """Wrap an already parsed `apt` dict, e.g. one from store.ListingStore"""
+        page = cls.__new__(cls)
+        page.apt = apt
+        page.soup = None
+        page.known_reviews = None
+        page.enrichment = {}
+        return page
+
+    def enrich(self, stages, defer=False):
+        """Run enrichment stages now, or in the background if `defer`."""
+        for stage in stages:
+            method = getattr(self, self.enrichers[stage])
+            if defer:
+                self.enrichment[stage] = enrichment_executor().submit(self._run_enricher, stage, method)
+            else:
+                self._run_enricher(stage, method)
+
+    @staticmethod
+    def _run_enricher(stage, method):
+        with metrics.timer('enrich', stage=stage):
+            method()
+
+    def enriched(self):
+        """Tell whether every deferred enrichment stage has finished."""
+        return all(f.done() for f in self.enrichment.values())
+
+    def wait(self, timeout=None):
+        """Wait for the deferred enrichment stages, re-raising their errors."""
+        for future in self.enrichment.values():
+            future.result(timeout)
+        return self
+
+    def when_enriched(self, callback):
+        """Call `callback(page)` once every deferred enrichment stage has
+        finished (right away if there is none)."""
+        pending = list(self.enrichment.values())
+        if not pending:
+            callback(self)
+            return
+        remaining = [len(pending)]
+        lock = threading.Lock()
+
+        def done(future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                callback(self)
+        for future in pending:
+            future.add_done_callback(done)
 
     def _extract_apt_name(self):
         if 'name' in self.apt:
@@ -50,85 +405,51 @@ class ApartmentPage():
         address['zipcode'] = statezip[1].text
         self.apt.update(address)
 
-    @staticmethod
-    def _extract_price_range(text):
-        prices = text.split(' - ')
-        if len(prices) == 1:
-            try:
-                lower = upper = locale.atoi(prices[0].strip('$'))
-            except ValueError:
-                lower = upper = None
-        else:
-            lower = locale.atoi(prices[0].strip('$'))
-            upper = locale.atoi(prices[1].strip('$'))
-        return lower, upper
-
-    @staticmethod
-    def _extract_br_range(text):
-        rooms = text.split(' - ')
-        if rooms[0].lower() == 'studio':
-            lower = 0
-        else:
-            lower = int(rooms[0][0])
-
-        if len(rooms) > 1:
-            upper = int(rooms[1][0])
-        else:
-            upper = lower
-        return lower, upper
-
-    @staticmethod
-    def _extract_ba_range(text):
-        baths = text.split(' - ')
-        if len(baths) == 1:
-            lower = upper = int(baths[0][0])
-        else:
-            lower = int(baths[0][0])
-            upper = int(baths[1][0])
-        return lower, upper
-
-    @staticmethod
-    def _extract_area_range(text):
-        text = text.replace(' sq ft', '')
-        areas = text.split(' - ')
-        if len(areas) == 1:
-            lower = upper = locale.atoi(areas[0])
-        else:
-            lower = locale.atoi(areas[0])
-            upper = locale.atoi(areas[1])
-        return lower, upper
+    # Locale-free and thread-safe, see parsing.py
+    _extract_price_range = staticmethod(parsing.price_range)
+    _extract_br_range = staticmethod(parsing.bed_range)
+    _extract_ba_range = staticmethod(parsing.bath_range)
+    _extract_area_range = staticmethod(parsing.area_range)
 
     def _extract_apt_overall(self):
         container = self.soup.find_all('div', class_='priceBedRangeInfoInnerContainer')
         for item in container:
             infotype = item.find(class_='rentInfoLabel').text
             infoval = item.find(class_='rentInfoDetail').text
-            if infotype == 'Monthly Rent':
-                lower, upper = self._extract_price_range(infoval)
-                self.apt['min_rent'] = lower
-                self.apt['max_rent'] = upper
-            elif infotype == 'Bedrooms':
-                lower, upper = self._extract_br_range(infoval)
-                self.apt['min_beds'] = lower
-                self.apt['max_beds'] = upper
-            elif infotype == 'Bathrooms':
-                lower, upper = self._extract_ba_range(infoval)
-                self.apt['min_baths'] = lower
-                self.apt['max_baths'] = upper
-            elif infotype == 'Square Feet':
-                lower, upper = self._extract_area_range(infoval)
-                self.apt['min_area_sqft'] = lower
-                self.apt['max_area_sqft'] = upper
+            self._apply_overall_info(infotype, infoval)
+
+    def _apply_overall_info(self, infotype, infoval):
+        if infotype == 'Monthly Rent':
+            lower, upper = self._extract_price_range(infoval)
+            self.apt['min_rent'] = lower
+            self.apt['max_rent'] = upper
+        elif infotype == 'Bedrooms':
+            lower, upper = self._extract_br_range(infoval)
+            self.apt['min_beds'] = lower
+            self.apt['max_beds'] = upper
+        elif infotype == 'Bathrooms':
+            lower, upper = self._extract_ba_range(infoval)
+            self.apt['min_baths'] = lower
+            self.apt['max_baths'] = upper
+        elif infotype == 'Square Feet':
+            lower, upper = self._extract_area_range(infoval)
+            self.apt['min_area_sqft'] = lower
+            self.apt['max_area_sqft'] = upper
 
     @staticmethod
     def _extract_model_summary(model):
         """model: a '<div>' node with class attribute equal to 'pricingGridItem'"""
+        name = model.find('span', class_='modelName').text
+        rent_label = model.find('span', class_='rentLabel').text
+        return ApartmentPage._model_summary(name, rent_label)
+
+    @staticmethod
+    def _model_summary(name, rent_label):
         desc = {}
         # name
-        desc['name'] = model.find('span', class_='modelName').text
+        desc['name'] = name
         # rent range
-        rent_label = model.find('span', class_='rentLabel').text.strip('\r\n ')
-        lower, upper = ApartmentPage._extract_price_range(rent_label)
+        lower, upper = ApartmentPage._extract_price_range(rent_label.strip('\r\n '))
         desc['min_rent'] = lower
         desc['max_rent'] = upper
         return desc
@@ -136,17 +457,22 @@ class ApartmentPage():
     @staticmethod
     def _extract_model_bed_baths(model):
         """model: a '<div>' node with class attribute equal to 'pricingGridItem'"""
-        desc = {}
         specs = model.find('span', class_='detailsTextWrapper').find_all('span')
+        return ApartmentPage._model_bed_baths([spec.text for spec in specs])
+
+    @staticmethod
+    def _model_bed_baths(specs):
+        """specs: text of the '<span>'s in the model's 'detailsTextWrapper'"""
+        desc = {}
         for spec in specs:
-            if spec.text.endswith('beds'):
-                desc['beds'] = int(spec.text.split(' ')[0])
-            elif spec.text.lower() == 'studio':
+            if spec.endswith('beds'):
+                desc['beds'] = int(spec.split(' ')[0])
+            elif spec.lower() == 'studio':
                 desc['beds'] = 0
-            elif spec.text.endswith('baths'):
-                desc['baths'] = int(spec.text.split(' ')[0])
-            elif spec.text.endswith('sq ft'):
-                lower, upper = ApartmentPage._extract_area_range(spec.text)
+            elif spec.endswith('baths'):
+                desc['baths'] = int(spec.split(' ')[0])
+            elif spec.endswith('sq ft'):
+                lower, upper = ApartmentPage._extract_area_range(spec)
                 desc['min_area_sqft'] = lower
                 desc['max_area_sqft'] = upper
         return desc
@@ -156,18 +482,23 @@ class ApartmentPage():
         unit_nodes = model.find_all('li', class_='unitContainer')
         units = []
         for u in unit_nodes:
-            unit_name = u.find('div', class_='unitColumn').text.strip('\r\n ')
+            unit_name = u.find('div', class_='unitColumn').text
             pricestr = u.find('div', class_='pricingColumn').text
-            unit_price = locale.atoi(pricepat.search(pricestr).group(1))
             datestr = u.find('span', class_='dateAvailable').text
-            avail = datepat.search(datestr).group(0)
-            units.append({
-                'unit': unit_name,
-                'price': unit_price,
-                'date_available': avail
-            })
+            units.append(ApartmentPage._unit(unit_name, pricestr, datestr))
         return units
 
+    @staticmethod
+    def _unit(unit_name, pricestr, datestr, today=None):
+        avail = parsing.availability(datestr)
+        available_on = parsing.available_date(avail, today)
+        return {
+            'unit': unit_name.strip('\r\n '),
+            'price': parsing.unit_price(pricestr),
+            'date_available': avail,
+            'available_on': available_on.isoformat() if available_on is not None else None
+        }
+
     def _extract_floor_plans(self):
         self.apt['floorplans'] = []
         models = self.soup.find_all('div', class_='pricingGridItem')
@@ -218,6 +549,7 @@ class ApartmentPage():
 
     def _get_amenities_of_a_category(self, category):
         """category: an <h2> title node"""
+        import bs4
         amenities = []
         for sib in category.next_siblings:
             if not isinstance(sib, bs4.element.Tag):
@@ -238,6 +570,45 @@ class ApartmentPage():
             amenities[title] = self._get_amenities_of_a_category(cat)
         self.apt['amenities'] = amenities
 
+    def _apply_parsed(self, parser):
+        """parser: an AptDetailPageParser that has been fed the page"""
+        sections = parser.sections
+        if 'name' in sections and 'name' not in self.apt:
+            self.apt['name'] = parser.page['name'].strip('\r\n ')
+        if 'address' in sections and 'street' not in self.apt:
+            street_city = parser.address['spans']
+            statezip = parser.address['statezip']
+            self.apt.update({
+                'street': street_city[0],
+                'city': street_city[1],
+                'state': statezip[0],
+                'zipcode': statezip[1]
+            })
+        for item in parser.overall:
+            self._apply_overall_info(item['label'], item['detail'])
+        if 'floorplans' in sections:
+            self.apt['floorplans'] = []
+        for model in parser.models:
+            model_desc = self._model_summary(model['name'], model['rent'])
+            model_desc.update(self._model_bed_baths(model['details']))
+            model_desc['amenities'] = model['amenities']
+            model_desc['leasing_term'] = model['leasing'][0]
+            model_desc['deposit'] = model['leasing'][1]
+            model_desc['date_available'] = model.get('avail')
+            model_desc['units'] = [self._unit(u['unit'], u['price'], u['date']) for u in model['units']]
+            self.apt['floorplans'].append(model_desc)
+        if parser.description is not None:
+            self.apt['about'] = parser.description['about']
+            self.apt['features'] = [feat['span'] for feat in parser.description['features']]
+        if parser.contact is not None:
+            self.apt['tel'] = parser.contact['tel']
+            self.apt['website'] = parser.contact['website']
+        if 'amenities' in sections:
+            amenities = {}
+            for cat in parser.amenities:
+                amenities[cat['title']] = [spec['span'] for spec in cat['items']]
+            self.apt['amenities'] = amenities
+
     def _filter_reviews(self, reviews):
         res = []
         for r in reviews:
@@ -255,22 +626,38 @@ class ApartmentPage():
             })
         return res
 
-    def _get_google_reviews(self):
+    def _enrich_reviews(self):
+        self._get_google_reviews(self.known_reviews)
+
+    def _enrich_geo(self):
+        """Coordinates of the listing from the offline geocoder (see geo.py)"""
+        import geo
+        found = geo.default_geocoder().locate(self.apt)
+        if found is not None:
+            self.apt['lat'], self.apt['lon'], self.apt['geo_precision'] = found
+
+    def _get_google_reviews(self, known_reviews=None):
+        """known_reviews: reviews collected earlier; only newer ones are
+        fetched and they are added in front"""
+        import requests
         keyword = '%s %s %s %s' % (
             self.name, self.street, self.city, self.state
         )
-        search_res = google.search(keyword)
-        fid = google.extract_feature_id(search_res)
-        all_reviews = []
-        next_page = ''
-        while True:
-            sleep(random.randint(1000, 10000) / 1000)
-            reviews, next_page = google.load_comments(fid,
-                    sort_by='newestFirst', next_page_token=next_page)
-            print('Retrieved %d reviews' % len(reviews), file=sys.stderr)
-            all_reviews.extend(self._filter_reviews(reviews))
-            if not next_page:
-                break
+        known = None
+        if known_reviews is not None:
+            known = set(reviews.review_key(r) for r in known_reviews)
+        try:
+            fetched = reviews.default_fetcher().fetch_keyword(keyword, known=known, url=self.apt.get('url'))
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # Google throttled us past the retries; keep what we had
+            metrics.count('failures', stage='reviews')
+            print('Reviews of %s failed: %r' % (self.name, e), file=sys.stderr)
+            if known_reviews is not None:
+                self.apt['reviews'] = list(known_reviews)
+            return
+        all_reviews = self._filter_reviews(fetched)
+        if known_reviews is not None:
+            all_reviews.extend(known_reviews)
         self.apt['reviews'] = all_reviews
 
     def __getattr__(self, key):
@@ -284,12 +671,63 @@ class ApartmentPage():
         return self.apt[key]
 
 
+def parse_page(body, encoding, apt_summary, engine='stream', sections=None):
+    """Parse the raw bytes of a detail page without enriching it, for running
+    in another process. Returns the `apt` dict and the seconds it took."""
+    start = time.perf_counter()
+    page = ApartmentPage(body.decode(encoding or 'utf-8', errors='replace'), apt_summary,
+        engine=engine, sections=sections, enrich=())
+    return page.apt, time.perf_counter() - start
+
+
+def help():
+    print('Usage: %s [options] [url...]' % sys.argv[0])
+    print('')
+    print('Prints the details of listings as JSON.')
+    print('')
+    print('Options:')
+    print('  --no-reviews: Do not collect Google reviews')
+    print('  --ndjson: Print each listing as a line of JSON')
+    print('  --watch <N>: Keep running and fetch the listings again every N seconds, printing each')
+    print('    new or changed one as a JSON line {"event": "new" | "changed", "url": ..., "listing": ...,')
+    print('    "changes": [...]} (stop with Ctrl-C)')
+
+
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        url = sys.argv[1]
-    else:
-        url = 'https://www.apartments.com/elan-menlo-park-menlo-park-ca/9yntwg4/'
-
-    resp = sess.get(url)
-    apt_detail = ApartmentPage(resp.text, {})
-    print(json.dumps(apt_detail.apt, indent=2))
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['no-reviews', 'ndjson', 'watch='])
+    except getopt.GetoptError as e:
+        print(e)
+        exit(1)
+
+    enrich = ('reviews',)
+    ndjson = False
+    watch_interval = None
+    for k, v in opts:
+        if k == '--no-reviews':
+            enrich = ()
+        elif k == '--ndjson':
+            ndjson = True
+        elif k == '--watch':
+            watch_interval = float(v)
+        elif k == '-h':
+            help()
+            exit(0)
+
+    urls = args or ['https://www.apartments.com/elan-menlo-park-menlo-park-ca/9yntwg4/']
+
+    if watch_interval is not None:
+        from watch import Watcher, write_ndjson
+        try:
+            write_ndjson(Watcher(urls=urls, interval=watch_interval, details=True, enrich=enrich).run())
+        except KeyboardInterrupt:
+            pass
+        exit(0)
+
+    for url in urls:
+        resp = session().get(url, stream=True)
+        apt_detail = ApartmentPage(iter_response(resp), {'url': url}, engine='stream', enrich=enrich)
+        if ndjson:
+            print(json.dumps(apt_detail.apt), flush=True)
+        else:
+            print(json.dumps(apt_detail.apt, indent=2))
@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+from apartments import AptSearchPageParser, scan_search_page, search_results
+from apt_detail import AptDetailPageParser
+from bs4 import BeautifulSoup
+from common import data_dir, feed_chunks
+from datetime import date
+from fixtures import OfflinePage, listing_fields, render_comments, render_detail_page, \
+    render_search_page, synthetic_listing
+
+import getopt
+import glob
+import google
+import json
+import locale
+import os
+import parsing
+import platform
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# Kinds of fixtures, by the prefix of their file name in a fixture directory
+fixture_kinds = ('search', 'detail', 'review')
+# Command line tools whose start up is benchmarked
+startup_tools = ('apartments', 'apt_detail', 'crawler', 'query', 'export')
+
+
+def synthetic_fixtures(floorplans=300, units=10, listings=40):
+    """Fixtures rendered from example-apt-detail.json: a search page, the
+    example detail page, a large detail page with `floorplans` floor plans
+    of `units` units, and a page of Google reviews."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, 'example-apt-detail.json')) as f:
+        example = json.load(f)
+    apt = listing_fields(example)
+    summaries = [{
+        'name': '%s %d' % (apt['name'], i),
+        'url': 'https://www.apartments.com/%s-%d/%07x/' % (apt['name'].lower(), i, i),
+        'street': apt['street'],
+        'city': apt['city'],
+        'state': apt['state'],
+        'zipcode': apt['zipcode']
+    } for i in range(listings)]
+    return {
+        'search': [('synthetic-%d' % listings, render_search_page(summaries, 1, 28))],
+        'detail': [
+            ('example', render_detail_page(apt)),
+            ('synthetic-%dx%d' % (floorplans, units),
+                render_detail_page(synthetic_listing(apt, floorplans, units)))
+        ],
+        'review': [('example', render_comments(example['reviews'], 'next'))]
+    }
+
+
+def recorded_fixtures(directory):
+    """Fixtures saved in `directory` as <kind>-<name>.<ext>, e.g. by
+    record_fixtures()."""
+    fixtures = dict((kind, []) for kind in fixture_kinds)
+    for path in sorted(glob.glob(os.path.join(directory, '*'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        kind, _, name = name.partition('-')
+        if kind in fixtures:
+            with open(path, encoding='utf-8') as f:
+                fixtures[kind].append(('recorded-' + name, f.read()))
+    return fixtures
+
+
+def record_fixtures(directory, cache=None):
+    """Save the search, detail and review pages of the HTTP cache (see
+    cache.py) to `directory` as fixtures. Returns how many were saved."""
+    from cache import DiskCache, classify
+    if cache is None:
+        cache = DiskCache()
+    os.makedirs(directory, exist_ok=True)
+    saved = 0
+    for key, url, status in cache.items():
+        kind = classify(url)
+        if kind not in fixture_kinds or status != 200:
+            continue
+        entry = cache.get(key)
+        ext = 'json' if kind == 'review' else 'html'
+        with open(os.path.join(directory, '%s-%s.%s' % (kind, key[:12], ext)), 'wb') as f:
+            f.write(entry['body'])
+        saved += 1
+    return saved
+
+
+def measure(stages, repeat, trace_memory=True):
+    """Run `stages`, a list of (name, function) run in order on each round,
+    `repeat` times, then once more under tracemalloc unless `trace_memory`
+    is false. Each function gets the result of the previous one. Returns
+    {name: (mean seconds, min seconds, peak KiB allocated during the stage
+    or None)}."""
+    times = dict((name, []) for name, _ in stages)
+    for _ in range(repeat):
+        value = None
+        for name, fn in stages:
+            start = time.perf_counter()
+            value = fn(value)
+            times[name].append(time.perf_counter() - start)
+    if not trace_memory:
+        return dict((name, (sum(t) / len(t), min(t), None)) for name, t in times.items())
+    peaks = {}
+    tracemalloc.start()
+    try:
+        value = None
+        for name, fn in stages:
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            value = fn(value)
+            peaks[name] = (tracemalloc.get_traced_memory()[1] - base) / 1024
+    finally:
+        tracemalloc.stop()
+    return dict((name, (sum(t) / len(t), min(t), peaks[name])) for name, t in times.items())
+
+
+def search_stages(text):
+    def parse(_):
+        parser = AptSearchPageParser()
+        parser.feed(text)
+        parser.close()
+        return parser
+    return [('parse', parse), ('search_results', search_results)]
+
+
+def scan_stages(text):
+    """The byte-level fast path of search_stages(), on the encoded page."""
+    content = text.encode('utf-8')
+    return [('scan', lambda _: scan_search_page(content)), ('search_results', search_results)]
+
+
+def soup_stages(text):
+    def tree(_):
+        page = OfflinePage.from_record({})
+        page.soup = BeautifulSoup(text.replace('–', '-'), 'html.parser')
+        return page
+
+    def extractor(section):
+        def run(page):
+            getattr(page, OfflinePage.extractors[section])()
+            return page
+        return run
+    return [('soup', tree)] + [(OfflinePage.extractors[section], extractor(section))
+        for section in OfflinePage.sections]
+
+
+def stream_stages(text):
+    def parse(_):
+        return feed_chunks(AptDetailPageParser(), (text,))
+
+    def apply(parser):
+        page = OfflinePage.from_record({})
+        page._apply_parsed(parser)
+        return page
+    return [('parse', parse), ('_apply_parsed', apply)]
+
+
+# The helpers of apt_detail.py parsing.py replaced, for comparison
+_old_datepat = re.compile(r'(Now|Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Nov|Dec)(\w*\. \d+)?')
+_old_pricepat = re.compile(r'\$([0-9,]+)')
+
+
+def _old_price_range(text):
+    prices = text.split(' - ')
+    if len(prices) == 1:
+        try:
+            lower = upper = locale.atoi(prices[0].strip('$'))
+        except ValueError:
+            lower = upper = None
+    else:
+        lower = locale.atoi(prices[0].strip('$'))
+        upper = locale.atoi(prices[1].strip('$'))
+    return lower, upper
+
+
+def _old_area_range(text):
+    areas = text.replace(' sq ft', '').split(' - ')
+    if len(areas) == 1:
+        lower = upper = locale.atoi(areas[0])
+    else:
+        lower = locale.atoi(areas[0])
+        upper = locale.atoi(areas[1])
+    return lower, upper
+
+
+def _old_unit_price(text):
+    return locale.atoi(_old_pricepat.search(text).group(1))
+
+
+def _old_availability(text):
+    match = _old_datepat.search(text)
+    return match.group(0) if match else None
+
+
+def field_stages(text, old=False):
+    """The parsers of parsing.py on every rent, size, price and
+    availability string of a detail page, collected by the stream parser.
+
+    With `old`, the locale.atoi helpers they replaced instead, under the
+    same stage names (see --old-fields). Those need a locale grouping
+    thousands with commas; without en_US.UTF-8 the commas are removed from
+    the strings beforehand."""
+    parser = feed_chunks(AptDetailPageParser(), (text,))
+    rents = [model['rent'].strip('\r\n ') for model in parser.models]
+    areas = [spec for model in parser.models for spec in model.get('details', ())
+        if spec.endswith('sq ft')]
+    units = [unit for model in parser.models for unit in model['units']]
+    prices = [unit['price'] for unit in units]
+    dates = [unit['date'] for unit in units]
+    today = date.today()
+
+    def each(fn, strings):
+        return lambda _: [fn(s) for s in strings]
+    if old:
+        try:
+            locale.setlocale(locale.LC_NUMERIC, 'en_US.UTF-8')
+        except locale.Error:
+            locale.setlocale(locale.LC_NUMERIC, 'C')
+            rents, areas, prices = ([s.replace(',', '') for s in strings] for strings in (rents, areas, prices))
+        return [
+            ('price_range', each(_old_price_range, rents)),
+            ('area_range', each(_old_area_range, areas)),
+            ('unit_price', each(_old_unit_price, prices)),
+            ('availability', each(_old_availability, dates)),
+            ('available_date', lambda _: [parsing.available_date(_old_availability(s), today) for s in dates])
+        ]
+    return [
+        ('price_range', each(parsing.price_range, rents)),
+        ('area_range', each(parsing.area_range, areas)),
+        ('unit_price', each(parsing.unit_price, prices)),
+        ('availability', each(parsing.availability, dates)),
+        ('available_date', lambda _: [parsing.available_date(parsing.availability(s), today) for s in dates])
+    ]
+
+
+def review_stages(text):
+    def parse(_):
+        return google.parse_comments(text)[0]
+    return [('parse_comments', parse),
+        ('_filter_reviews', lambda reviews: OfflinePage._filter_reviews(None, reviews))]
+
+
+def startup_stages(tool=None):
+    """Start up of a command line tool in a fresh interpreter, up to
+    printing its help; of the bare interpreter when `tool` is None. Their
+    memory is not measured: tracemalloc only sees this process, and on Linux
+    the maximum RSS of a child includes this process at the fork."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    if tool is None:
+        name, args = 'interpreter', ('-c', 'pass')
+    else:
+        name, args = '-h', (os.path.join(here, tool + '.py'), '-h')
+
+    def start(_):
+        subprocess.run((sys.executable,) + args, cwd=here, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, check=True)
+    return [(name, start)]
+
+
+def count_items(kind, text):
+    """Listings, units or reviews in a fixture, for throughput."""
+    if kind == 'startup':
+        return 1
+    if kind == 'search':
+        return len(search_results(search_stages(text)[0][1](None)))
+    if kind == 'detail':
+        page = OfflinePage(text, {}, engine='stream', enrich=())
+        return sum(len(model['units']) for model in page.apt.get('floorplans', [])) or 1
+    return len(google.parse_comments(text)[0])
+
+
+def run(fixtures, repeat=5, pattern=None, old_fields=False):
+    """Benchmark every fixture; returns a list of result dicts. With
+    `old_fields`, the field benchmarks time the helpers parsing.py
+    replaced."""
+    benches = []
+    for kind, items in fixtures.items():
+        for fixture, text in items:
+            if kind == 'search':
+                benches.append(('search.%s' % fixture, kind, text, search_stages(text)))
+                benches.append(('search.%s.scan' % fixture, kind, text, scan_stages(text)))
+            elif kind == 'detail':
+                benches.append(('detail.%s.soup' % fixture, kind, text, soup_stages(text)))
+                benches.append(('detail.%s.stream' % fixture, kind, text, stream_stages(text)))
+                benches.append(('detail.%s.fields' % fixture, kind, text, field_stages(text, old_fields)))
+            else:
+                benches.append(('review.%s' % fixture, kind, text, review_stages(text)))
+    benches.append(('startup.python', 'startup', '', startup_stages()))
+    for tool in startup_tools:
+        benches.append(('startup.%s' % tool, 'startup', '', startup_stages(tool)))
+    results = []
+    for name, kind, text, stages in benches:
+        if pattern is not None and pattern not in name:
+            continue
+        size = len(text.encode('utf-8'))
+        try:
+            items = count_items(kind, text)
+            timings = measure(stages, repeat, trace_memory=kind != 'startup')
+        except Exception as e:
+            print('Skipping %s: %r' % (name, e), file=sys.stderr)
+            continue
+        total = sum(t[0] for t in timings.values())
+        peaks = [t[2] for t in timings.values() if t[2] is not None]
+        results.append({
+            'name': name,
+            'bytes': size,
+            'items': items,
+            'seconds': total,
+            'items_per_second': items / total,
+            'mb_per_second': size / total / 1e6,
+            'peak_kib': max(peaks) if peaks else None,
+            'stages': dict((stage, {'seconds': t[0], 'min_seconds': t[1], 'peak_kib': t[2]})
+                for stage, t in timings.items())
+        })
+    return results
+
+
+def report(results, baseline=None, out=sys.stdout):
+    """Print results, with the change of time against `baseline` results."""
+    previous = {}
+    if baseline is not None:
+        for result in baseline['results']:
+            previous[result['name']] = result
+            for stage, timing in result['stages'].items():
+                previous['%s/%s' % (result['name'], stage)] = timing
+
+    def change(key, seconds):
+        if key not in previous:
+            return ''
+        return '%+.1f%%' % ((seconds / previous[key]['seconds'] - 1) * 100)
+
+    def kib(value, width):
+        return '%*.0f KiB' % (width, value) if value is not None else ' ' * (width + 4)
+
+    for result in results:
+        print('%-40s %9.2f ms %9.1f items/s %7.2f MB/s %s %s' % (
+            result['name'], result['seconds'] * 1000, result['items_per_second'],
+            result['mb_per_second'], kib(result['peak_kib'], 9), change(result['name'], result['seconds'])),
+            file=out)
+        for stage, timing in result['stages'].items():
+            print('  %-38s %9.2f ms %s %s' % (stage, timing['seconds'] * 1000,
+                kib(timing['peak_kib'], 38), change('%s/%s' % (result['name'], stage), timing['seconds'])),
+                file=out)
+
+
+def help():
+    print('Usage: %s [options]' % sys.argv[0])
+    print('')
+    print('Benchmarks search page parsing and scanning, both detail page engines (per _extract_* stage),')
+    print('the field parsers and review handling on offline fixtures, and the start up time')
+    print('of the command line tools, and saves the results.')
+    print('')
+    print('Options:')
+    print('  -n, --repeat <N>: Rounds per benchmark (default: 5)')
+    print('  -k <text>: Only run benchmarks whose name contains <text>')
+    print('  --fixtures <dir>: Also benchmark the fixtures recorded in <dir>')
+    print('  --record <dir>: Save the pages of the HTTP cache to <dir> as fixtures and exit')
+    print('  --floorplans <N>, --units <N>: Size of the synthetic detail page (default: 300 x 10)')
+    print('  -o, --output <file>: Save results to <file> (default: bench/<time>.json in the data directory)')
+    print('  -c, --compare <file>: Show the change against results saved earlier')
+    print('  --old-fields: Time the locale.atoi helpers parsing.py replaced in the field benchmarks,')
+    print('    e.g. -k fields --old-fields -o old.json, then -k fields -c old.json')
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hn:k:o:c:', ['repeat=', 'fixtures=', 'record=',
+            'floorplans=', 'units=', 'output=', 'compare=', 'old-fields'])
+    except getopt.GetoptError as e:
+        print(e)
+        help()
+        exit(1)
+
+    repeat = 5
+    pattern = None
+    fixture_dir = None
+    floorplans = 300
+    units = 10
+    output = None
+    baseline = None
+    old_fields = False
+    for k, v in opts:
+        if k in ('-n', '--repeat'):
+            repeat = int(v)
+        elif k == '-k':
+            pattern = v
+        elif k == '--fixtures':
+            fixture_dir = v
+        elif k == '--record':
+            print('Saved %d fixtures to %s' % (record_fixtures(v), v))
+            exit(0)
+        elif k == '--floorplans':
+            floorplans = int(v)
+        elif k == '--units':
+            units = int(v)
+        elif k in ('-o', '--output'):
+            output = v
+        elif k in ('-c', '--compare'):
+            with open(v) as f:
+                baseline = json.load(f)
+        elif k == '--old-fields':
+            old_fields = True
+        elif k == '-h':
+            help()
+            exit(0)
+
+    fixtures = synthetic_fixtures(floorplans, units)
+    if fixture_dir is not None:
+        for kind, items in recorded_fixtures(fixture_dir).items():
+            fixtures[kind].extend(items)
+    results = run(fixtures, repeat, pattern, old_fields)
+    report(results, baseline)
+
+    if output is None:
+        os.makedirs(os.path.join(data_dir(), 'bench'), exist_ok=True)
+        output = os.path.join(data_dir(), 'bench', time.strftime('%Y%m%dT%H%M%S.json'))
+    with open(output, 'w') as f:
+        json.dump({
+            'time': time.time(),
+            'python': platform.python_version(),
+            'repeat': repeat,
+            'results': results
+        }, f, indent=2)
+    print('Saved results to %s' % output)
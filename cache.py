@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+from common import session as common_session, data_dir
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib.parse import urlsplit
+
+import hashlib
+import io
+import json
+import os
+import re
+import requests
+import sqlite3
+import threading
+import time
+
+# Seconds a cached response is served without asking the server again
+default_ttls = {
+    'search': 3600,
+    'detail': 6 * 3600,
+    'review': 24 * 3600,
+    'google': 7 * 24 * 3600,
+    'other': 3600
+}
+
+# Request headers that select a different representation of the same URL
+key_headers = ('Accept', 'Accept-Language')
+
+# Response headers that do not apply to the decoded body we store
+_dropped_headers = ('content-encoding', 'content-length', 'transfer-encoding', 'connection')
+
+_detail_id = re.compile(r'^(?=.*[0-9])(?=.*[a-z])[0-9a-z]{5,10}$')
+
+
+def classify(url):
+    """Tell which kind of page `url` is: 'search', 'detail', 'review',
+    'google' or 'other'. The kind selects the TTL."""
+    parts = urlsplit(url)
+    host = parts.netloc.lower()
+    if host.endswith('google.com'):
+        if parts.path.startswith('/async/reviewDialog'):
+            return 'review'
+        return 'google'
+    if host.endswith('apartments.com'):
+        segments = [seg for seg in parts.path.split('/') if seg]
+        if len(segments) == 2 and _detail_id.match(segments[1]):
+            return 'detail'
+        return 'search'
+    return 'other'
+
+
+class CacheMiss(requests.exceptions.RequestException):
+    pass
+
+
+class ResponseCache():
+    """Interface of a response store. Entries are dicts with 'url', 'status',
+    'headers', 'body' and 'stored' (a timestamp)."""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, entry):
+        raise NotImplementedError
+
+    def refresh(self, key, stored):
+        """Mark the entry as revalidated at `stored`."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryCache(ResponseCache):
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, entry):
+        self.entries[key] = entry
+
+    def refresh(self, key, stored):
+        if key in self.entries:
+            self.entries[key]['stored'] = stored
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+
+class DiskCache(ResponseCache):
+    """SQLite-backed cache, evicting the least recently used entries once the
+    bodies take more than `max_bytes`."""
+
+    def __init__(self, path=None, max_bytes=512 * 1024 * 1024):
+        if path is None:
+            path = os.path.join(data_dir(), 'http-cache.sqlite')
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, url TEXT, status INTEGER, headers TEXT,
+            body BLOB, size INTEGER, stored REAL, accessed REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.db.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT url, status, headers, body, stored FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+        return {
+            'url': row[0],
+            'status': row[1],
+            'headers': json.loads(row[2]),
+            'body': row[3],
+            'stored': row[4]
+        }
+
+    def set(self, key, entry):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+                key, entry['url'], entry['status'], json.dumps(entry['headers']),
+                entry['body'], len(entry['body']), entry['stored'], time.time()))
+            self._evict()
+            self.db.commit()
+
+    def refresh(self, key, stored):
+        with self.lock:
+            self.db.execute('UPDATE responses SET stored = ?, accessed = ? WHERE key = ?',
+                (stored, time.time(), key))
+            self.db.commit()
+
+    def delete(self, key):
+        with self.lock:
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.db.commit()
+
+    def items(self):
+        """(key, url, status) of every entry, least recently used first."""
+        with self.lock:
+            return self.db.execute('SELECT key, url, status FROM responses ORDER BY accessed').fetchall()
+
+    def size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def _evict(self):
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        freed = 0
+        victims = []
+        for key, size in self.db.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.db.executemany('DELETE FROM responses WHERE key = ?', victims)
+
+
+class CachingAdapter(BaseAdapter):
+    """Transport adapter that answers GET requests from `cache` while they are
+    fresh, revalidates stale entries with If-None-Match/If-Modified-Since, and
+    stores successful responses. In `offline` mode every request is answered
+    from the cache, however old, and misses raise CacheMiss."""
+
+    def __init__(self, cache, adapter=None, ttls=None, offline=False, classifier=classify):
+        super(CachingAdapter, self).__init__()
+        self.cache = cache
+        self.adapter = adapter if adapter is not None else HTTPAdapter()
+        self.ttls = dict(default_ttls)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        self.offline = offline
+        self.classifier = classifier
+
+    @staticmethod
+    def cache_key(request):
+        parts = [request.method, request.url]
+        for name in key_headers:
+            parts.append('%s:%s' % (name, request.headers.get(name, '')))
+        return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return self.adapter.send(request, **kwargs)
+        key = self.cache_key(request)
+        entry = self.cache.get(key)
+        now = time.time()
+        if entry is not None:
+            ttl = self.ttls[self.classifier(request.url)]
+            if self.offline or now - entry['stored'] < ttl:
+                return self.build_response(request, entry)
+        if self.offline:
+            raise CacheMiss('Not in cache: %s' % request.url, request=request)
+
+        if entry is not None:
+            headers = CaseInsensitiveDict(entry['headers'])
+            if 'ETag' in headers:
+                request.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                request.headers['If-Modified-Since'] = headers['Last-Modified']
+        resp = self.adapter.send(request, **kwargs)
+        if resp.status_code == 304 and entry is not None:
+            resp.close()
+            self.cache.refresh(key, now)
+            return self.build_response(request, entry)
+        if resp.status_code == 200:
+            headers = dict((k, v) for k, v in resp.headers.items() if k.lower() not in _dropped_headers)
+            self.cache.set(key, {
+                'url': request.url,
+                'status': resp.status_code,
+                'headers': headers,
+                'body': resp.content,
+                'stored': now
+            })
+        return resp
+
+    @staticmethod
+    def build_response(request, entry):
+        resp = requests.Response()
+        resp.status_code = entry['status']
+        resp.reason = 'OK'
+        resp.headers = CaseInsensitiveDict(entry['headers'])
+        resp.encoding = get_encoding_from_headers(resp.headers)
+        resp.raw = io.BytesIO(entry['body'])
+        resp._content = entry['body']
+        resp._content_consumed = True
+        resp.url = request.url
+        resp.request = request
+        resp.from_cache = True
+        return resp
+
+    def close(self):
+        self.adapter.close()
+
+
+def install_cache(cache=None, session=None, **kwargs):
+    """Put a CachingAdapter (see there for `kwargs`) under `session`, by
+    default the shared `common.session()`, using a DiskCache unless `cache` is
+    given. Unless given an `adapter`, misses go to the adapter the session
+    had (e.g. its control.FlowControlAdapter), so cache hits are not flow
+    controlled. Returns the adapter."""
+    if cache is None:
+        cache = DiskCache()
+    if session is None:
+        session = common_session()
+    if 'adapter' not in kwargs:
+        kwargs['adapter'] = _inner_adapter(session)
+    adapter = CachingAdapter(cache, **kwargs)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return adapter
+
+
+def _inner_adapter(session):
+    adapter = session.get_adapter('https://')
+    if isinstance(adapter, CachingAdapter):
+        return adapter.adapter
+    return adapter
+
+
+def uninstall_cache(session=None):
+    if session is None:
+        session = common_session()
+    adapter = _inner_adapter(session)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+from common import data_dir
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+class Checkpoint():
+    """Durable frontier of one crawl, so that a crawl that died can be
+    restarted where it stopped: the search result pages still to fetch, the
+    listings found but not crawled yet, the Google review pages of the
+    listings being enriched, and the record of every listing done.
+
+    Every change is committed to SQLite before the crawl moves on, and
+    changes that belong together (a search page and the listings found on
+    it) are committed at once, so the frontier survives the process being
+    killed at any point. Work in flight at that point is done again."""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(data_dir(), 'checkpoint.sqlite')
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS search_pages (
+            url TEXT, page INTEGER, done INTEGER, PRIMARY KEY (url, page))''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS listings (
+            url TEXT PRIMARY KEY, seq INTEGER, summary TEXT, apt TEXT, done REAL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS review_pages (
+            fid TEXT, sort_by TEXT, page INTEGER, reviews TEXT, next_page_token TEXT,
+            PRIMARY KEY (fid, sort_by, page))''')
+        self.db.commit()
+
+    # Search result pages
+
+    def add_search(self, url):
+        """Queue the first result page of a search unless it is known."""
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO search_pages VALUES (?, 1, 0)', (url,))
+            self.db.commit()
+
+    def pending_search_pages(self):
+        """(search url, page) of every result page not fetched yet."""
+        with self.lock:
+            return self.db.execute('''SELECT url, page FROM search_pages WHERE done = 0
+                ORDER BY page, url''').fetchall()
+
+    def search_page_done(self, url, page, summaries, pages=()):
+        """Record that result page `page` of `url` was fetched, with the
+        listing `summaries` found on it and the further `pages` it told about."""
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO search_pages VALUES (?, ?, 0)',
+                [(url, n) for n in pages])
+            self._add_listings(summaries)
+            self.db.execute('UPDATE search_pages SET done = 1 WHERE url = ? AND page = ?', (url, page))
+            self.db.commit()
+
+    # Listings
+
+    def _add_listings(self, summaries):
+        seq = self.db.execute('SELECT COALESCE(MAX(seq), 0) FROM listings').fetchone()[0]
+        for summary in summaries:
+            seq += 1
+            self.db.execute('INSERT OR IGNORE INTO listings VALUES (?, ?, ?, NULL, NULL)',
+                (summary['url'], seq, json.dumps(summary)))
+
+    def add_listings(self, summaries):
+        """Queue listing summaries (as returned by apartments.search_results)
+        that are not known yet."""
+        with self.lock:
+            self._add_listings(summaries)
+            self.db.commit()
+
+    def pending_listings(self):
+        """Summaries of the listings not crawled yet, in the order found."""
+        with self.lock:
+            rows = self.db.execute('SELECT summary FROM listings WHERE done IS NULL ORDER BY seq').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def listing_urls(self):
+        """URL of every listing known, crawled or not."""
+        with self.lock:
+            return set(row[0] for row in self.db.execute('SELECT url FROM listings'))
+
+    def is_done(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT done FROM listings WHERE url = ?', (url,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def complete(self, url, apt):
+        """Store the record of a crawled listing and take it off the frontier."""
+        with self.lock:
+            self.db.execute('''INSERT INTO listings
+                VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM listings), ?, ?, ?)
+                ON CONFLICT (url) DO UPDATE SET apt = excluded.apt, done = excluded.done''',
+                (url, json.dumps({'url': url}), json.dumps(apt), time.time()))
+            self.db.commit()
+
+    def records(self):
+        """The record of every listing done, in the order they were found."""
+        with self.lock:
+            rows = self.db.execute('SELECT apt FROM listings WHERE done IS NOT NULL ORDER BY seq').fetchall()
+        for row in rows:
+            yield json.loads(row[0])
+
+    # Google review pages
+
+    def review_pages(self, fid, sort_by):
+        """(reviews, next_page_token) of every review page of `fid` fetched
+        so far, in order."""
+        with self.lock:
+            rows = self.db.execute('''SELECT reviews, next_page_token FROM review_pages
+                WHERE fid = ? AND sort_by = ? ORDER BY page''', (fid, sort_by)).fetchall()
+        return [(json.loads(reviews), token) for reviews, token in rows]
+
+    def add_review_page(self, fid, sort_by, page, reviews, next_page_token):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO review_pages VALUES (?, ?, ?, ?, ?)',
+                (fid, sort_by, page, json.dumps(reviews), next_page_token))
+            self.db.commit()
+
+    def reviews_done(self, fid, sort_by):
+        """Forget the review pages of `fid` once all of them were used."""
+        with self.lock:
+            self.db.execute('DELETE FROM review_pages WHERE fid = ? AND sort_by = ?', (fid, sort_by))
+            self.db.commit()
+
+    def progress(self):
+        """Counts of search pages and listings, done and pending."""
+        with self.lock:
+            pages = dict(self.db.execute('SELECT done, COUNT(*) FROM search_pages GROUP BY done').fetchall())
+            listings = dict(self.db.execute('''SELECT done IS NOT NULL, COUNT(*) FROM listings
+                GROUP BY done IS NOT NULL''').fetchall())
+            reviews = self.db.execute('SELECT COUNT(DISTINCT fid) FROM review_pages').fetchone()[0]
+        return {
+            'search_pages_done': pages.get(1, 0),
+            'search_pages_pending': pages.get(0, 0),
+            'listings_done': listings.get(1, 0),
+            'listings_pending': listings.get(0, 0),
+            'review_cursors': reviews
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+if __name__ == '__main__':
+    # checkpoint.py <file>: print the progress of a crawl checkpoint
+    # checkpoint.py <file> records: print the records it holds as JSON lines
+    if len(sys.argv) < 2:
+        print('Usage: %s <checkpoint file> [records]' % sys.argv[0])
+        exit(1)
+    if not os.path.exists(sys.argv[1]):
+        print('No checkpoint at %s' % sys.argv[1])
+        exit(1)
+    checkpoint = Checkpoint(sys.argv[1])
+    if len(sys.argv) > 2 and sys.argv[2] == 'records':
+        for apt in checkpoint.records():
+            print(json.dumps(apt))
+    else:
+        for key, value in checkpoint.progress().items():
+            print('%s: %d' % (key, value))
@@ -1,24 +1,115 @@
 #!/usr/bin/env python3
 
 from html.parser import HTMLParser
-import requests
+from urllib.parse import urlsplit
+import codecs
+import metrics
+import os
+import re
+import sys
+import threading
+import time
 
 _UA_CHROME = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.110 Safari/537.36'
 
 req_header = {
     'User-Agent': _UA_CHROME
 }
-sess = requests.Session()
-sess.headers = req_header
+_non_word = re.compile(r'[^0-9a-z]+')
+_sess = None
+_sess_lock = threading.Lock()
+
+
+def session():
+    """The requests session shared by every fetch, made on first use: most
+    runs of the command line tools that only print their help, or read
+    stores and exports, never need requests or the adapters around it."""
+    global _sess
+    if _sess is None:
+        with _sess_lock:
+            if _sess is None:
+                import control
+                import requests
+                sess = requests.Session()
+                sess.headers = req_header
+                control.install(sess)
+                metrics.install(sess)
+                _sess = sess
+    return _sess
+
+
+def __getattr__(name):
+    # `common.sess` as it was before the session was made on first use
+    if name == 'sess':
+        return session()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def data_dir():
+    """Directory for the on-disk caches and stores."""
+    path = os.environ.get('APARTMENT_FINDER_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'apartment-finder'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def normalize(text):
+    """Lower case words of `text` separated by single spaces, the key of
+    names and addresses in the caches (fidcache, geo) and of amenities in
+    queries."""
+    return _non_word.sub(' ', text.lower()).strip()
+
+
+class TokenBucket():
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` tokens are available and take them."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class HostThrottle():
+    """Per-host rate limit: at most `rate` requests per second to each host."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.rate:
+            return
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            bucket = self.buckets[host]
+        bucket.acquire()
 
 
 class Tag():
+    # A Tag is made for every start tag the parsers see
+    __slots__ = ('name', 'attrs')
 
     def __init__(self, name, attrs):
         self.name = name
-        self.attrs = {}
-        for key, value in attrs:
-            self.attrs[key] = value
+        self.attrs = dict(attrs)
 
     def attr_eq(self, attr_name, attr_val):
         if attr_name not in self.attrs:
@@ -35,14 +126,47 @@ class Tag():
         return '<%s %s>' % (self.name, ' '.join(attrs_str_list))
 
     def __getattr__(self, name):
-        if name not in self.attrs:
-            return None
-        return self.attrs[name]
+        # Only reached for names that are not slots; an unset slot (e.g. while
+        # unpickling) must not recurse into self.attrs
+        if name in Tag.__slots__:
+            raise AttributeError(name)
+        return self.attrs.get(name)
 
     def __getitem__(self, key):
         return getattr(self, key)
 
 
+class Throughput():
+    """Counts events (e.g. 'pages', 'listings') and prints their rates to
+    `out` every `interval` seconds."""
+
+    def __init__(self, interval=10.0, out=sys.stderr):
+        self.interval = interval
+        self.out = out
+        self.counts = {}
+        self.start = self.last_report = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+            now = time.monotonic()
+            if self.interval is None or now - self.last_report < self.interval:
+                return
+            self.last_report = now
+        self.report()
+
+    def summary(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.start, 1e-9)
+            return ', '.join('%d %s (%.2f/s)' % (n, name, n / elapsed)
+                for name, n in self.counts.items()) + ' in %.1fs' % elapsed
+
+    def report(self):
+        if self.out is not None:
+            print(self.summary(), file=self.out, flush=True)
+
+
 html_void_tags = set([
     'area', 'base', 'br', 'col', 'embed',
     'hr', 'img', 'input', 'link', 'meta',
@@ -54,6 +178,8 @@ class MyHTMLParser(HTMLParser):
         super(MyHTMLParser, self).__init__()
         self.tags = []
         self.curr_tag = None
+        # Set by subclasses once they have everything they need from the page
+        self.done = False
 
     def on_starttag(self, tag):
         pass
@@ -69,8 +195,15 @@ class MyHTMLParser(HTMLParser):
         pass
 
     def handle_endtag(self, tag):
-        self.on_endtag(self.tags[-1])
-        if self.tags[-1].name == tag:
+        # Close every element up to the most recent open `tag`, the way
+        # BeautifulSoup does; stray end tags are ignored.
+        for i in range(len(self.tags) - 1, -1, -1):
+            if self.tags[i].name == tag:
+                break
+        else:
+            return
+        while len(self.tags) > i:
+            self.on_endtag(self.tags[-1])
             self.tags.pop()
 
     def on_startendtag(self, tag):
@@ -87,3 +220,53 @@ class MyHTMLParser(HTMLParser):
     def handle_data(self, data):
         self.on_data(data)
 
+
+def iter_response(resp, chunk_size=16384, decode=True):
+    """Yield the body of a `stream=True` response as decoded text chunks as
+    they arrive from the socket, or as bytes without `decode`."""
+    if resp.encoding is None:
+        resp.encoding = 'utf-8'
+    decoder = codecs.getincrementaldecoder(resp.encoding)(errors='replace') if decode else None
+    nbytes = 0
+    try:
+        for chunk in resp.iter_content(chunk_size):
+            nbytes += len(chunk)
+            if decoder is None:
+                yield chunk
+                continue
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        if decoder is not None:
+            text = decoder.decode(b'', final=True)
+            if text:
+                yield text
+    finally:
+        resp.close()
+        metrics.record_stream(resp, nbytes)
+
+
+def decode_chunks(chunks, encoding):
+    """Decode byte chunks into text chunks."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+
+def feed_chunks(parser, chunks):
+    """Feed text chunks into a MyHTMLParser, stopping as soon as the parser
+    is done with the page."""
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.done:
+            break
+    else:
+        parser.close()
+    if hasattr(chunks, 'close'):
+        chunks.close()
+    return parser
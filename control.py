@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+from email.utils import parsedate_to_datetime
+from requests.adapters import BaseAdapter, HTTPAdapter
+from urllib.parse import urlsplit
+
+import metrics
+import random
+import requests
+import threading
+import time
+
+# Responses retried with a backoff, and the ones telling that we go too fast
+retry_statuses = (429, 500, 502, 503, 504)
+throttle_statuses = (429, 503)
+
+# Methods that are safe to send again
+idempotent_methods = ('GET', 'HEAD', 'OPTIONS')
+
+
+class CircuitOpen(requests.exceptions.RequestException):
+    pass
+
+
+def is_throttled(resp):
+    """Tell whether `resp` asks us to slow down: a 429 or 503, or Google's
+    redirect to its /sorry/ captcha page."""
+    if resp.status_code in throttle_statuses:
+        return True
+    return resp.is_redirect and '/sorry/' in resp.headers.get('Location', '')
+
+
+def retry_after(resp, now=None):
+    """Seconds the Retry-After header of `resp` asks to wait, None without
+    one."""
+    value = resp.headers.get('Retry-After')
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when - (time.time() if now is None else now))
+
+
+class HostControl():
+    """Flow control of the requests to one host.
+
+    Concurrency: at most `limit` requests are in flight. The limit grows by
+    about one per `limit` successful requests and halves when the host
+    throttles us or times out (at most once per `decrease_interval` seconds,
+    so a burst of 429s to the requests already in flight counts once).
+
+    Circuit breaking: after `failure_threshold` failures in a row the circuit
+    opens and requests fail with CircuitOpen for `cooldown` seconds. Then
+    one request is let through; its success closes the circuit, its failure
+    opens it again."""
+
+    def __init__(self, host, initial=4, minimum=1, maximum=32, failure_threshold=5, cooldown=30.0,
+            decrease_interval=1.0):
+        self.host = host
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.decrease_interval = decrease_interval
+        self.inflight = 0
+        self.failures = 0
+        self.state = 'closed'
+        self.open_until = 0.0
+        self.probing = False
+        self.pause_until = 0.0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for a request slot; raises CircuitOpen while the circuit is
+        open."""
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.state == 'open':
+                    if now < self.open_until:
+                        raise CircuitOpen('Circuit open for %s for %.0f more seconds' % (
+                            self.host, self.open_until - now))
+                    self.state = 'half-open'
+                    self.probing = False
+                if now < self.pause_until:
+                    self.cond.wait(self.pause_until - now)
+                elif self.state == 'half-open':
+                    if not self.probing:
+                        self.probing = True
+                        self.inflight += 1
+                        return
+                    self.cond.wait(self.cooldown)
+                elif self.inflight < max(self.minimum, int(self.limit)):
+                    self.inflight += 1
+                    return
+                else:
+                    self.cond.wait()
+
+    def release(self, ok, congested=False):
+        """Give the slot back, with the outcome of its request (None if it
+        tells nothing about the host)."""
+        with self.cond:
+            self.inflight -= 1
+            now = time.monotonic()
+            if ok:
+                self.failures = 0
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                if self.state == 'half-open':
+                    self.state = 'closed'
+                    self.probing = False
+                    metrics.count('circuit', host=self.host, state='closed')
+            elif ok is not None:
+                self.failures += 1
+                if congested and now - self.last_decrease >= self.decrease_interval:
+                    self.last_decrease = now
+                    self.limit = max(float(self.minimum), self.limit / 2)
+                if self.state == 'half-open' or (self.state == 'closed' and
+                        self.failures >= self.failure_threshold):
+                    self.state = 'open'
+                    self.open_until = now + self.cooldown
+                    self.probing = False
+                    metrics.count('circuit', host=self.host, state='open')
+            else:
+                # Let another request probe a half-open circuit
+                self.probing = False
+            self.cond.notify_all()
+
+    def pause(self, seconds):
+        """Hold every request to the host for `seconds`, e.g. for Retry-After."""
+        with self.cond:
+            self.pause_until = max(self.pause_until, time.monotonic() + seconds)
+
+
+class FlowControlAdapter(BaseAdapter):
+    """Transport adapter putting every request through the HostControl of
+    its host and retrying idempotent requests that fail with a connection
+    error, a timeout or one of `retry_statuses`, up to `max_retries` times.
+
+    Retries wait the Retry-After of the response when there is one (the
+    response is returned as is if it asks for more than `max_retry_after`
+    seconds), otherwise a random time up to backoff * 2 ** attempt seconds,
+    capped at `max_backoff` ("full jitter"). Throttled responses also hold
+    the other requests to the host for that time.
+
+    The number of retries is set as `retries` on the response. Streamed
+    responses give their slot back once the headers have arrived."""
+
+    def __init__(self, adapter=None, max_retries=4, backoff=0.5, max_backoff=60.0, max_retry_after=300.0,
+            throttled=is_throttled, **host_options):
+        super(FlowControlAdapter, self).__init__()
+        self.adapter = adapter if adapter is not None else HTTPAdapter()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.throttled = throttled
+        self.host_options = host_options
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostControl(host, **self.host_options)
+            return self.hosts[host]
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def send(self, request, **kwargs):
+        control = self.host(request.url)
+        retries = self.max_retries if request.method in idempotent_methods else 0
+        attempt = 0
+        while True:
+            control.acquire()
+            try:
+                resp = self.adapter.send(request, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                control.release(False, isinstance(e, requests.exceptions.Timeout))
+                if attempt >= retries:
+                    raise
+                delay = self.delay(attempt)
+            except BaseException:
+                control.release(None)
+                raise
+            else:
+                throttled = self.throttled(resp)
+                if not throttled and resp.status_code not in retry_statuses:
+                    control.release(True)
+                    resp.retries = attempt
+                    return resp
+                control.release(False, throttled)
+                if throttled:
+                    metrics.count('throttled', host=control.host)
+                delay = retry_after(resp)
+                if attempt >= retries or (delay is not None and delay > self.max_retry_after):
+                    resp.retries = attempt
+                    return resp
+                if delay is None:
+                    delay = self.delay(attempt)
+                if throttled:
+                    control.pause(delay)
+                resp.close()
+            with metrics.timer('backoff', host=control.host):
+                time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.adapter.close()
+
+
+def install(session, **kwargs):
+    """Put a FlowControlAdapter (see there for `kwargs`) under `session`.
+    Returns the adapter."""
+    adapter = FlowControlAdapter(**kwargs)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return adapter
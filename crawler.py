@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+from apartments import find_apartments, iter_apartments, parse_criteria, criteria_shortopts, criteria_longopts, \
+    help_filters, help_pages, help_cache, help_metrics
+from apt_detail import ApartmentPage, parse_page
+from checkpoint import Checkpoint
+from common import session, HostThrottle, iter_response
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from reviewstore import ReviewStore
+from store import ListingStore, page_hash
+
+import contextlib
+import getopt
+import itertools
+import json
+import metrics
+import multiprocessing
+import os
+import queue
+import reviews
+import sys
+import threading
+
+
+class ParsePool():
+    """Parses detail pages on `processes` worker processes (all cores by
+    default), so that parsing is not limited to the one core the GIL allows.
+    At most `backlog` pages are being fetched or parsed through the pool at a
+    time; fetching more waits for a slot, which bounds the raw pages held in
+    memory."""
+
+    def __init__(self, processes=None, backlog=None):
+        if not processes:
+            processes = os.cpu_count() or 1
+        methods = multiprocessing.get_all_start_methods()
+        # Forking a process that runs I/O threads is unsafe
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        self.executor = ProcessPoolExecutor(processes, mp_context=context)
+        self.slots = threading.BoundedSemaphore(backlog or 4 * processes)
+
+    def slot(self):
+        """Context manager held from before fetching a page until it is parsed."""
+        return self.slots
+
+    def parse(self, body, encoding, apt_summary, engine='stream'):
+        """Parse raw page bytes in a worker; returns the `apt` dict."""
+        apt, seconds = self.executor.submit(parse_page, body, encoding, apt_summary, engine).result()
+        metrics.observe('detail.parse', seconds, engine=engine, mode='process')
+        return apt
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def fetch_detail(summary, throttle, engine='stream', store=None, enrich=('reviews',), defer=False,
+        pool=None):
+    """pool: a ParsePool to parse the page in; the listing is enriched in the
+    calling thread."""
+    url = summary['url']
+    if store is None and pool is None:
+        with metrics.timer('detail.throttle'):
+            throttle.wait(url)
+        if engine == 'stream':
+            with metrics.timer('detail.fetch'):
+                resp = session().get(url, stream=True)
+            return ApartmentPage(iter_response(resp), dict(summary), engine=engine,
+                enrich=enrich, defer=defer)
+        with metrics.timer('detail.fetch'):
+            resp = session().get(url)
+        return ApartmentPage(resp.text, dict(summary), engine=engine, enrich=enrich, defer=defer)
+
+    # The whole page is needed to tell whether it changed and to ship it to
+    # another process
+    with pool.slot() if pool is not None else contextlib.nullcontext():
+        with metrics.timer('detail.throttle'):
+            throttle.wait(url)
+        with metrics.timer('detail.fetch'):
+            resp = session().get(url)
+        known_reviews = None
+        unchanged = None
+        if store is not None:
+            digest = page_hash(resp.content)
+            unchanged = store.get_unchanged(url, digest)
+        if unchanged is not None:
+            metrics.count('store', result='unchanged')
+        elif store is not None:
+            previous = store.get(url)
+            metrics.count('store', result='changed' if previous is not None else 'new')
+            known_reviews = previous.get('reviews') if previous is not None else None
+        if pool is not None and unchanged is None:
+            apt = pool.parse(resp.content, resp.encoding, dict(summary), engine)
+    if unchanged is not None:
+        # The page is not parsed again, but its reviews and other enrichment
+        # may have changed since
+        page = ApartmentPage.from_record(unchanged)
+        page.changes = []
+        if enrich:
+            page.known_reviews = unchanged.get('reviews')
+            page.enrich(enrich, defer)
+            page.when_enriched(lambda p: store.save(url, digest, p.apt))
+        return page
+    if pool is not None:
+        page = ApartmentPage.from_record(apt)
+        page.known_reviews = known_reviews
+        page.enrich(enrich, defer)
+    else:
+        page = ApartmentPage(resp.text, dict(summary), engine=engine, known_reviews=known_reviews,
+            enrich=enrich, defer=defer)
+    if store is None:
+        return page
+    if 'reviews' not in enrich and known_reviews is not None:
+        page.apt['reviews'] = known_reviews
+    page.changes = store.save(url, digest, page.apt)
+    if page.enrichment:
+        # Store the enriched record again once the deferred stages are done
+        page.when_enriched(lambda p: store.save(url, digest, p.apt))
+    return page
+
+
+def crawl(apts, max_workers=8, rate=1.0, burst=1, engine='stream', store=None,
+        enrich=('reviews',), defer=False, stats=None, processes=None, checkpoint=None):
+    """Fetch and parse the detail page of every summary in `apts` (as returned
+    by `find_apartments()`), at most `max_workers` at a time and at most `rate`
+    requests per second per host. Yields each ApartmentPage as soon as it is
+    done; listings that fail are reported on stderr and skipped.
+
+    store: a store.ListingStore. Pages that did not change since they were
+    stored are not parsed again, and every page gets a `changes` list of its
+    unit changes.
+    enrich, defer: enrichment stages of every page, see ApartmentPage. With
+    `defer` pages are yielded as soon as they are parsed.
+    stats: a common.Throughput counting 'details'.
+    processes: parse pages on a ParsePool of this many processes (0 for one
+    per core) while the `max_workers` threads only fetch; give it more
+    threads than processes to keep every core busy.
+    checkpoint: a checkpoint.Checkpoint. The listings it has pending are
+    crawled first, listings it has done are skipped, and the record of every
+    page is saved to it once enriched. Give it to search_all() and the
+    ReviewFetcher too (reviews.configure(checkpoint=...)) to also resume
+    searches and review pages."""
+    throttle = HostThrottle(rate, burst)
+    finished = queue.Queue()
+    pool = ParsePool(processes) if processes is not None else None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            contextlib.closing(pool) if pool is not None else contextlib.nullcontext():
+        # `apts` may be a lazy iterator (e.g. iter_apartments()), so listings
+        # are submitted from another thread as they arrive
+        def listings():
+            if checkpoint is None:
+                yield from apts
+                return
+            submitted = set()
+            for apt in itertools.chain(checkpoint.pending_listings(), apts):
+                if apt['url'] in submitted or checkpoint.is_done(apt['url']):
+                    continue
+                submitted.add(apt['url'])
+                checkpoint.add_listings([apt])
+                yield apt
+
+        def submit_all():
+            count = 0
+            error = None
+            try:
+                for apt in listings():
+                    future = executor.submit(fetch_detail, apt, throttle, engine, store, enrich, defer,
+                        pool)
+                    future.add_done_callback(lambda f, apt=apt: finished.put((apt, f)))
+                    count += 1
+            except Exception as e:
+                error = e
+            finished.put((None, (count, error)))
+
+        threading.Thread(target=submit_all, daemon=True).start()
+        done = 0
+        total = None
+        while total is None or done < total:
+            apt, future = finished.get()
+            if apt is None:
+                total, error = future
+                continue
+            done += 1
+            try:
+                page = future.result()
+            except Exception as e:
+                metrics.count('failures', stage='detail')
+                print('Failed to crawl %s: %r' % (apt['url'], e), file=sys.stderr)
+                continue
+            if checkpoint is not None:
+                page.when_enriched(lambda p, url=apt['url']: checkpoint.complete(url, p.apt))
+            if stats is not None:
+                stats.add('details')
+            yield page
+        if error is not None:
+            raise error
+
+
+def help():
+    print('Usage: %s [options] [filters...] <location>' % sys.argv[0])
+    print('')
+    print('Options:')
+    print('  -j, --jobs <N>: Number of listings fetched concurrently (default: 8)')
+    print('  --rate <N>: Maximum requests per second per host (default: 1, 0 for unlimited)')
+    print('  -p, --processes <N>: Parse pages on N processes, 0 for one per core (default: parse')
+    print('    on the fetching threads)')
+    help_pages()
+    help_cache()
+    print('  --store: Keep parsed listings in the listing store and only parse changed pages')
+    print('  --no-reviews: Do not collect Google reviews')
+    print('  --geo: Add the coordinates of every listing from the offline geocoder (see geo.py)')
+    print('  --review-store: Keep Google reviews in the review store, fetching only new ones, and')
+    print('    index them for searching (see reviewstore.py)')
+    print('  --checkpoint <file>: Record the progress of the crawl in <file>; running again with the')
+    print('    same file resumes the crawl, skipping the listings done (see checkpoint.py)')
+    help_metrics()
+    print('')
+    help_filters()
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hj:p:' + criteria_shortopts,
+            ['jobs=', 'processes=', 'rate=', 'all-pages', 'cache', 'offline', 'store', 'no-reviews', 'geo',
+            'metrics=', 'metrics-port=', 'checkpoint=', 'review-store'] + criteria_longopts)
+    except getopt.GetoptError as e:
+        print(e)
+        help()
+        exit(1)
+
+    criteria = {}
+    jobs = 8
+    processes = None
+    rate = 1.0
+    use_cache = False
+    offline = False
+    store = None
+    enrich = ('reviews',)
+    geo = False
+    all_pages = False
+    metrics_file = None
+    checkpoint = None
+    review_options = {}
+    for k, v in opts:
+        if parse_criteria(k, v, criteria):
+            continue
+        elif k in ('-j', '--jobs'):
+            jobs = int(v)
+        elif k in ('-p', '--processes'):
+            processes = int(v)
+        elif k == '--rate':
+            rate = float(v)
+        elif k == '--all-pages':
+            all_pages = True
+        elif k == '--cache':
+            use_cache = True
+        elif k == '--offline':
+            offline = True
+        elif k == '--store':
+            store = ListingStore()
+        elif k == '--no-reviews':
+            enrich = ()
+        elif k == '--geo':
+            geo = True
+        elif k == '--metrics':
+            metrics_file = v
+        elif k == '--metrics-port':
+            metrics.registry.serve(int(v))
+        elif k == '--checkpoint':
+            checkpoint = Checkpoint(v)
+            review_options['checkpoint'] = checkpoint
+        elif k == '--review-store':
+            review_options['review_store'] = ReviewStore()
+        elif k == '-h':
+            help()
+            exit(0)
+        else:
+            print('Unrecognized option %s' % k)
+            help()
+            exit(1)
+
+    location = ' '.join(args)
+    if not location:
+        help()
+        exit(1)
+
+    if use_cache or offline:
+        from cache import install_cache
+        install_cache(offline=offline)
+
+    if geo:
+        enrich += ('geo',)
+    if review_options and 'reviews' in enrich:
+        reviews.configure(**review_options)
+
+    if all_pages:
+        apts = iter_apartments(location, checkpoint=checkpoint, **criteria)
+    else:
+        apts = find_apartments(location, **criteria)
+    for page in crawl(apts, max_workers=jobs, rate=rate, store=store, enrich=enrich, processes=processes,
+            checkpoint=checkpoint):
+        print(json.dumps(page.apt), flush=True)
+        if store is not None and page.changes:
+            print('%s: %d unit changes' % (page.name, len(page.changes)), file=sys.stderr)
+    print(metrics.registry.summary(), file=sys.stderr)
+    if metrics_file is not None:
+        metrics.save(metrics_file)
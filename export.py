@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+from datetime import datetime
+
+import csv
+import getopt
+import glob
+import hashlib
+import importlib.util
+import os
+import re
+import records
+import sys
+
+# pyarrow takes longer to import than the rest of the program, so it is only
+# imported to read or write Parquet (see _pyarrow())
+has_pyarrow = importlib.util.find_spec('pyarrow') is not None
+
+# Columns of every table, in order
+tables = {
+    'listings': ['listing_id', 'url', 'name', 'street', 'city', 'state', 'zipcode', 'lat', 'lon',
+        'min_rent', 'max_rent', 'min_beds', 'max_beds', 'min_baths', 'max_baths',
+        'min_area_sqft', 'max_area_sqft', 'tel', 'website', 'crawl_id'],
+    'floorplans': ['floorplan_id', 'listing_id', 'name', 'min_rent', 'max_rent', 'beds', 'baths',
+        'min_area_sqft', 'max_area_sqft', 'leasing_term', 'deposit', 'date_available', 'crawl_id'],
+    'units': ['unit_id', 'floorplan_id', 'listing_id', 'unit', 'price', 'date_available', 'available_on',
+        'crawl_id'],
+    'amenities': ['listing_id', 'floorplan_id', 'category', 'amenity', 'crawl_id'],
+    'reviews': ['review_id', 'listing_id', 'author', 'rating', 'publish_date', 'text',
+        'translated', 'thumbs_up_count', 'crawl_id'],
+}
+
+# Columns that are not strings
+int_columns = set(['min_rent', 'max_rent', 'min_beds', 'max_beds', 'min_baths', 'max_baths',
+    'min_area_sqft', 'max_area_sqft', 'beds', 'baths', 'price', 'rating', 'thumbs_up_count'])
+bool_columns = set(['translated'])
+float_columns = set(['lat', 'lon'])
+
+_listing_id = re.compile(r'/([0-9a-z]{5,10})/?$')
+
+
+def _digest(*parts):
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:12]
+
+
+def listing_id(url):
+    """Stable key of a listing: the apartments.com listing id at the end of
+    its URL, or a hash of the URL."""
+    match = _listing_id.search(url)
+    if match is not None:
+        return match.group(1)
+    return _digest(url)
+
+
+def flatten(apts, crawl_id):
+    """Flatten `apt` dicts (ApartmentPage.apt, with 'url') into one dict of
+    columns per table. Floor plans repeated on the page (one per tab) and
+    their units are kept once."""
+    cols = dict((name, dict((c, []) for c in columns)) for name, columns in tables.items())
+
+    def add(table, row):
+        for column in tables[table]:
+            cols[table][column].append(row.get(column))
+
+    for apt in apts:
+        lid = listing_id(apt['url'])
+        row = dict(apt)
+        row.update({'listing_id': lid, 'crawl_id': crawl_id})
+        add('listings', row)
+        for category, amenities in apt.get('amenities', {}).items():
+            for amenity in amenities:
+                add('amenities', {'listing_id': lid, 'category': category, 'amenity': amenity,
+                    'crawl_id': crawl_id})
+        seen = set()
+        for model in apt.get('floorplans', []):
+            fid = '%s:%s' % (lid, _digest(model['name']))
+            if fid in seen:
+                continue
+            seen.add(fid)
+            row = dict(model)
+            row.update({'floorplan_id': fid, 'listing_id': lid, 'crawl_id': crawl_id})
+            add('floorplans', row)
+            for amenity in model['amenities']:
+                add('amenities', {'listing_id': lid, 'floorplan_id': fid, 'category': 'Floor Plan',
+                    'amenity': amenity, 'crawl_id': crawl_id})
+            for unit in model['units']:
+                row = dict(unit)
+                row.update({'unit_id': '%s:%s' % (fid, unit['unit']), 'floorplan_id': fid,
+                    'listing_id': lid, 'crawl_id': crawl_id})
+                add('units', row)
+        for review in apt.get('reviews', []):
+            text = review['review_text'].get('full_html')
+            add('reviews', {
+                'review_id': '%s:%s' % (lid, _digest(review['author'], text or '')),
+                'listing_id': lid,
+                'author': review['author'],
+                'rating': review['rating'],
+                'publish_date': review['publish_date'].get('localized_date'),
+                'text': text,
+                'translated': review['translated'],
+                'thumbs_up_count': review['thumbs_up_count'],
+                'crawl_id': crawl_id
+            })
+    return cols
+
+
+def _pyarrow():
+    import pyarrow
+    import pyarrow.parquet
+    return pyarrow
+
+
+def _arrow_type(column):
+    pyarrow = _pyarrow()
+    if column in int_columns:
+        return pyarrow.int64()
+    if column in bool_columns:
+        return pyarrow.bool_()
+    if column in float_columns:
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+def _write_parquet(path, table, columns):
+    pyarrow = _pyarrow()
+    schema = pyarrow.schema([(c, _arrow_type(c)) for c in tables[table]])
+    arrays = [pyarrow.array(columns[c], type=_arrow_type(c)) for c in tables[table]]
+    pyarrow.parquet.write_table(pyarrow.Table.from_arrays(arrays, schema=schema), path)
+
+
+def _write_csv(path, table, columns):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(tables[table])
+        writer.writerows(zip(*[columns[c] for c in tables[table]]))
+
+
+def export(apts, directory, fmt=None, crawl_id=None):
+    """Append `apts` to the tables under `directory`, one file per table and
+    crawl: <directory>/<table>/part-<crawl_id>.<fmt>. fmt is 'parquet'
+    (needs pyarrow, the default when it is installed) or 'csv'. Returns the
+    crawl id."""
+    if fmt is None:
+        fmt = 'parquet' if has_pyarrow else 'csv'
+    if fmt == 'parquet' and not has_pyarrow:
+        raise RuntimeError('Parquet export needs pyarrow')
+    if fmt not in ('parquet', 'csv'):
+        raise ValueError('Unknown export format: %s' % fmt)
+    if crawl_id is None:
+        crawl_id = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+    cols = flatten(apts, crawl_id)
+    for table, columns in cols.items():
+        os.makedirs(os.path.join(directory, table), exist_ok=True)
+        path = os.path.join(directory, table, 'part-%s.%s' % (crawl_id, fmt))
+        if fmt == 'parquet':
+            _write_parquet(path, table, columns)
+        else:
+            _write_csv(path, table, columns)
+    return crawl_id
+
+
+def _csv_value(column, value):
+    if value == '':
+        return None
+    if column in int_columns:
+        return int(value)
+    if column in bool_columns:
+        return value == 'True'
+    if column in float_columns:
+        return float(value)
+    return value
+
+
+def _read_csv(path, table, cols):
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        # Columns added after the crawl was exported
+        missing = [c for c in tables[table] if c not in header]
+        for row in reader:
+            for column, value in zip(header, row):
+                cols[column].append(_csv_value(column, value))
+            for column in missing:
+                cols[column].append(None)
+
+
+def load_table(directory, table):
+    """Read every crawl of `table` back as a dict of column lists, or as a
+    pyarrow.Table if any crawl was exported as Parquet. Each crawl is read
+    in the format it was exported in."""
+    parts = sorted(glob.glob(os.path.join(directory, table, 'part-*.parquet')) +
+        glob.glob(os.path.join(directory, table, 'part-*.csv')))
+    if not any(p.endswith('.parquet') for p in parts):
+        cols = dict((c, []) for c in tables[table])
+        for path in parts:
+            _read_csv(path, table, cols)
+        return cols
+    pyarrow = _pyarrow()
+    schema = pyarrow.schema([(c, _arrow_type(c)) for c in tables[table]])
+    read = []
+    for path in parts:
+        if path.endswith('.csv'):
+            cols = dict((c, []) for c in tables[table])
+            _read_csv(path, table, cols)
+            read.append(pyarrow.Table.from_arrays([pyarrow.array(cols[c], type=_arrow_type(c))
+                for c in tables[table]], schema=schema))
+            continue
+        part = pyarrow.parquet.read_table(path)
+        # Columns added after the crawl was exported
+        read.append(pyarrow.Table.from_arrays([part.column(c) if c in part.column_names
+            else pyarrow.nulls(part.num_rows, _arrow_type(c)) for c in tables[table]], schema=schema))
+    return pyarrow.concat_tables(read)
+
+
+def read_records(paths):
+    """Read `apt` records, one JSON object per line, from `paths` (stdin if
+    there are none), as compact records.Listing objects."""
+    files = [open(p) for p in paths] if paths else [sys.stdin]
+    for f in files:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield records.loads(line)
+
+
+def help():
+    print('Usage: %s [options] [listings.ndjson...]' % sys.argv[0])
+    print('')
+    print('Appends listings (one JSON record per line, e.g. the output of crawler.py)')
+    print('to columnar tables of listings, floorplans, units, amenities and reviews.')
+    print('')
+    print('Options:')
+    print('  -o, --output <dir>: Output directory (default: listings)')
+    print('  -f, --format <parquet | csv>: File format (default: parquet if pyarrow is installed)')
+    print('  --store: Export the listing store instead of JSON records')
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'ho:f:', ['output=', 'format=', 'store'])
+    except getopt.GetoptError as e:
+        print(e)
+        help()
+        exit(1)
+
+    directory = 'listings'
+    fmt = None
+    use_store = False
+    for k, v in opts:
+        if k in ('-o', '--output'):
+            directory = v
+        elif k in ('-f', '--format'):
+            fmt = v
+        elif k == '--store':
+            use_store = True
+        elif k == '-h':
+            help()
+            exit(0)
+
+    if use_store:
+        from store import ListingStore
+        store = ListingStore()
+        apts = []
+        for url in store.urls():
+            apt = records.Listing.from_dict(store.get(url))
+            apt.setdefault('url', url)
+            apts.append(apt)
+    else:
+        apts = list(read_records(args))
+    crawl_id = export(apts, directory, fmt)
+    print('Exported %d listings as crawl %s' % (len(apts), crawl_id))
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+from common import data_dir, normalize
+
+import getopt
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+class FidCache():
+    """Persistent map of property identity to Google feature id, keyed by
+    the normalized review search keyword (name, street, city and state, see
+    common.normalize). Searches that found no feature id are remembered for
+    `miss_ttl` seconds."""
+
+    def __init__(self, path=None, miss_ttl=7 * 24 * 3600):
+        if path is None:
+            path = os.path.join(data_dir(), 'fids.sqlite')
+        self.miss_ttl = miss_ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS fids (key TEXT PRIMARY KEY, fid TEXT, updated REAL)')
+        self.db.commit()
+
+    def lookup(self, keyword):
+        """Return (hit, fid). A hit with fid None is a remembered miss."""
+        with self.lock:
+            row = self.db.execute('SELECT fid, updated FROM fids WHERE key = ?',
+                (normalize(keyword),)).fetchone()
+        if row is None:
+            return False, None
+        fid, updated = row
+        if fid is None and time.time() - updated > self.miss_ttl:
+            return False, None
+        return True, fid
+
+    def set(self, keyword, fid):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO fids VALUES (?, ?, ?)',
+                (normalize(keyword), fid, time.time()))
+            self.db.commit()
+
+    def invalidate(self, keyword=None):
+        """Forget the feature id of `keyword`, or every entry if None."""
+        with self.lock:
+            if keyword is None:
+                self.db.execute('DELETE FROM fids')
+            else:
+                self.db.execute('DELETE FROM fids WHERE key = ?', (normalize(keyword),))
+            self.db.commit()
+
+    def items(self):
+        with self.lock:
+            return self.db.execute('SELECT key, fid, updated FROM fids ORDER BY key').fetchall()
+
+
+def help():
+    print('Usage: %s [options] [name street city state]' % sys.argv[0])
+    print('')
+    print('Lists the Google feature ids of properties cached for their reviews.')
+    print('')
+    print('Options:')
+    print('  -d: Forget the feature id of the property given, or of every property')
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hd')
+    except getopt.GetoptError as e:
+        print(e)
+        help()
+        exit(1)
+
+    delete = False
+    for k, v in opts:
+        if k == '-d':
+            delete = True
+        elif k == '-h':
+            help()
+            exit(0)
+
+    cache = FidCache()
+    if delete:
+        cache.invalidate(' '.join(args) or None)
+        exit(0)
+    for key, fid, updated in cache.items():
+        print('%s\t%s\t%s' % (key, fid if fid is not None else '-',
+            time.strftime('%Y-%m-%d', time.localtime(updated))))
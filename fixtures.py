@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+
+from apartments import AptSearchPageParser, AptSearchPageScanner, scan_search_page
+from apt_detail import ApartmentPage
+from common import feed_chunks
+from html import escape
+from parsing import available_date
+
+import itertools
+import json
+import random
+import sys
+
+
+def _num(n):
+    return '{:,}'.format(n)
+
+
+def _range(lower, upper, fmt, suffix=''):
+    if lower == upper:
+        return fmt(lower) + suffix
+    return '%s – %s%s' % (fmt(lower), fmt(upper), suffix)
+
+
+def _price(n):
+    return '$' + _num(n)
+
+
+def _price_range(lower, upper):
+    if lower is None:
+        return 'Call for Rent'
+    return _range(lower, upper, _price)
+
+
+def _beds(n):
+    return 'Studio' if n == 0 else '%d' % n
+
+
+def _model_specs(model):
+    specs = []
+    if 'beds' not in model:
+        specs.append('1 bed')
+    elif model['beds'] == 0:
+        specs.append('Studio')
+    else:
+        specs.append('%d beds' % model['beds'])
+    if 'baths' not in model:
+        specs.append('1 bath')
+    else:
+        specs.append('%d baths' % model['baths'])
+    if 'min_area_sqft' in model:
+        specs.append(_range(model['min_area_sqft'], model['max_area_sqft'], _num, ' sq ft'))
+    return specs
+
+
+def _render_unit(unit):
+    return '''
+        <li class="unitContainer js-unitContainer">
+          <div class="unitColumn column">
+            <span class="screenReaderOnly">%s</span>
+          </div>
+          <div class="pricingColumn column">
+            <span class="screenReaderOnly">price </span>
+            <span>%s</span>
+          </div>
+          <div class="availableColumn column">
+            <span class="dateAvailable">
+              <span class="screenReaderOnly">availibility </span>
+              %s
+            </span>
+          </div>
+        </li>''' % (escape(unit['unit']), _price(unit['price']), unit['date_available'])
+
+
+def _render_model(model):
+    parts = ['''
+    <div class="pricingGridItem multiFamily hasUnitGrid" data-tab-content-id="all">
+      <div class="priceGridModelWrapper">
+        <h3 class="modelLabel">
+          <span class="modelName">%s</span>
+          <span class="rentLabel">
+            %s
+          </span>
+        </h3>
+        <h4 class="detailsLabel">
+          <span class="detailsTextWrapper">%s</span>
+        </h4>''' % (
+        escape(model['name']),
+        _price_range(model['min_rent'], model['max_rent']),
+        ''.join('<span>%s</span>' % spec for spec in _model_specs(model)))]
+    if model['date_available'] is not None:
+        parts.append('<span class="availabilityInfo">%s</span>' % escape(model['date_available']))
+    parts.append('<ul class="amenitiesList">')
+    for am in model['amenities']:
+        parts.append('<li><span class="amenity">%s</span></li>' % escape(am))
+    parts.append('</ul>')
+    parts.append('<span class="leaseDepositLabel"><span>%s</span><span>%s</span></span>' % (
+        escape(model['leasing_term']), escape(model['deposit'])))
+    parts.append('<ul class="unitList">')
+    for unit in model['units']:
+        parts.append(_render_unit(unit))
+    parts.append('</ul>\n      </div>\n    </div>')
+    return ''.join(parts)
+
+
+def render_detail_page(apt):
+    """Render an apartments.com-like detail page from an `apt` dict (e.g.
+    example-apt-detail.json) that ApartmentPage parses back into the same
+    listing fields."""
+    overall = [
+        ('Monthly Rent', _price_range(apt['min_rent'], apt['max_rent'])),
+        ('Bedrooms', _range(apt['min_beds'], apt['max_beds'], _beds, ' bd')),
+        ('Bathrooms', _range(apt['min_baths'], apt['max_baths'], str, ' ba')),
+        ('Square Feet', _range(apt['min_area_sqft'], apt['max_area_sqft'], _num, ' sq ft')),
+    ]
+    parts = ['''<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <title>%s - %s, %s | Apartments.com</title>
+  <script type="text/javascript">var startup = { "page": "<span>detail</span>" };</script>
+  <style>.rentInfoLabel { font-weight: bold; }</style>
+</head>
+<body>
+  <!-- header -->
+  <header><nav><a href="/">Apartments.com</a><br></nav></header>
+  <main id="main">
+  <section class="propertyNameRow">
+    <h1 class="propertyName" id="propertyName">
+      %s
+    </h1>
+    <div class="propertyAddressContainer">
+      <h2>
+        <span>%s</span><span>%s</span>
+        <span class="stateZipContainer"><span>%s</span> <span>%s</span></span>
+      </h2>
+    </div>
+  </section>
+  <ul class="priceBedRangeInfo">''' % (
+        escape(apt['name']), escape(apt['city']), apt['state'], escape(apt['name']),
+        escape(apt['street']), escape(apt['city']), apt['state'], apt['zipcode'])]
+    for label, detail in overall:
+        parts.append('''
+    <li class="column"><div class="priceBedRangeInfoInnerContainer">
+      <p class="rentInfoLabel">%s</p><p class="rentInfoDetail">%s</p>
+    </div></li>''' % (label, detail))
+    parts.append('\n  </ul>\n  <section class="pricingSection">')
+    for model in apt['floorplans']:
+        parts.append(_render_model(model))
+    parts.append('\n  </section>')
+    if 'about' in apt:
+        parts.append('\n  <section class="descriptionSection">\n    <h2 class="sectionTitle">About %s</h2>' % escape(apt['name']))
+        for p in apt['about']:
+            parts.append('\n    <p>%s</p>' % escape(p))
+        parts.append('\n    <ul class="uniqueFeatures">')
+        for feat in apt['features']:
+            parts.append('<li class="uniqueAmenity"><span>%s</span></li>' % escape(feat))
+        parts.append('</ul>\n  </section>')
+    parts.append('\n  <section class="amenitiesSection">\n    <div class="sectionContainer">')
+    for title, specs in apt['amenities'].items():
+        parts.append('\n      <h2 class="sectionTitle">%s</h2>' % escape(title))
+        parts.append('\n      <div class="specGroup"><span>Highlights</span></div>')
+        parts.append('\n      <div class="spec"><ul class="specList">')
+        for spec in specs:
+            parts.append('<li class="specInfo"><span>%s</span></li>' % escape(spec))
+        parts.append('</ul></div>')
+    parts.append('\n    </div>\n  </section>')
+    if 'tel' in apt:
+        parts.append('''
+  <section id="officeHoursSection" class="officeHoursSection">
+    <div class="phoneNumber"><a href="tel:%s"><span>%s</span></a></div>
+    <a class="propertyWebsiteLink" href="%s" target="_blank">Property Website</a>
+  </section>''' % (escape(apt['tel']), escape(apt['tel']), escape(apt['website'])))
+    parts.append('\n  </main>\n</body>\n</html>\n')
+    return ''.join(parts)
+
+
+def synthetic_listing(apt, floorplans=300, units=10, seed=0):
+    """A copy of `apt` with `floorplans` floor plans of `units` units each,
+    cloned from its own floor plans, for pages larger than real ones."""
+    rng = random.Random(seed)
+    models = [m for m in apt['floorplans'] if m['units']] or apt['floorplans']
+    dates = ['Now', 'Jan. 24', 'Feb. 22', 'Mar. 3', 'Apr. 15']
+    big = dict(apt)
+    big['floorplans'] = []
+    for i in range(floorplans):
+        model = dict(models[i % len(models)])
+        model['name'] = '%s %d' % (model['name'], i)
+        model['units'] = []
+        for j in range(units):
+            model['units'].append({
+                'unit': 'Unit %d%02d' % (i, j),
+                'price': rng.randint(1500, 6000),
+                'date_available': rng.choice(dates)
+            })
+        if model['units']:
+            prices = [u['price'] for u in model['units']]
+            model['min_rent'], model['max_rent'] = min(prices), max(prices)
+        big['floorplans'].append(model)
+    return big
+
+
+def render_search_page(summaries, page=1, pages=1):
+    """Render a search result page listing `summaries` (dicts with 'name',
+    'url', 'street', 'city', 'state' and 'zipcode', as returned by
+    apartments.search_results) the way apartments.com does: an ld+json block
+    followed by a placard per listing."""
+    items = [{
+        '@type': 'ApartmentComplex',
+        'location': [
+            {'@type': 'Place', 'url': s['url']},
+            {'@type': 'Place', 'name': s['name'], 'address': {
+                '@type': 'PostalAddress',
+                'streetAddress': s['street'],
+                'addressLocality': s['city'],
+                'addressRegion': s['state'],
+                'postalCode': s['zipcode']
+            }}
+        ]
+    } for s in summaries]
+    parts = ['''<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <title>Apartments for Rent | Apartments.com</title>
+  <script type="application/ld+json">%s</script>
+</head>
+<body>
+  <main id="main"><section id="placards"><ul>''' % json.dumps(items)]
+    for s in summaries:
+        parts.append('''
+    <li class="mortar-wrapper"><article class="placard" data-url="%s">
+      <header class="placard-header"><div class="property-title">%s</div>
+        <div class="property-address">%s, %s, %s %s</div></header>
+      <section class="placard-content"><div class="property-pricing">Call for Rent</div>
+        <div class="property-beds">Studio - 3 Beds</div>
+        <ul class="property-amenities"><li>Pool</li><li>Fitness Center</li><li>Dishwasher</li></ul>
+      </section>
+    </article></li>''' % (escape(s['url']), escape(s['name']), escape(s['street']),
+            escape(s['city']), s['state'], s['zipcode']))
+    parts.append('''
+  </ul></section>
+  <nav id="paging"><span class="pageRange">Page %d of %d</span></nav>
+  </main>
+</body>
+</html>
+''' % (page, pages))
+    return ''.join(parts)
+
+
+def render_comments(reviews, next_page_token=''):
+    """Render a Google review dialog response (see google.parse_comments)
+    from filtered reviews such as those of example-apt-detail.json."""
+    raw = [{
+        'author_real_name': r['author'],
+        'publish_date': r['publish_date'],
+        'review_text': r['review_text'],
+        'star_rating': {'value': r['rating']},
+        'translated': r['translated'],
+        'thumbs_up_count': r['thumbs_up_count']
+    } for r in reviews]
+    body = {'localReviewsDialogProto': {'reviews': {
+        'other_user_review': raw,
+        'next_page_token': next_page_token
+    }}}
+    return ")]}'\n" + json.dumps(body)
+
+
+class OfflinePage(ApartmentPage):
+    """ApartmentPage that does not contact Google for reviews."""
+
+    def _get_google_reviews(self, known_reviews=None):
+        pass
+
+
+def listing_fields(apt):
+    return dict((k, v) for k, v in apt.items() if k != 'reviews')
+
+
+def with_available_dates(apt, today=None):
+    """A copy of `apt` whose units have the 'available_on' date the parser
+    derives from their 'date_available' text."""
+    apt = dict(apt)
+    apt['floorplans'] = [dict(model, units=[dict(unit, available_on=unit.get('available_on',
+        _iso(available_date(unit['date_available'], today)))) for unit in model['units']])
+        for model in apt['floorplans']]
+    return apt
+
+
+# Availability labels as listings write them, with and without a period
+availability_labels = ('Now', 'Feb. 22', 'May 22', 'June 5', 'Sept. 1')
+
+
+def with_availability_labels(apt):
+    """A copy of `apt` whose units cycle through availability_labels."""
+    labels = itertools.cycle(availability_labels)
+    apt = dict(apt)
+    apt['floorplans'] = [dict(model, units=[dict(((k, v) for k, v in unit.items() if k != 'available_on'),
+        date_available=next(labels)) for unit in model['units']]) for model in apt['floorplans']]
+    return apt
+
+
+def _iso(day):
+    return day.isoformat() if day is not None else None
+
+
+def check_engines(html_text, expected=None):
+    """Parse `html_text` with every extraction engine and return a list of
+    (engine, problem) for engines whose output differs."""
+    results = {}
+    for engine in ('soup', 'stream'):
+        results[engine] = OfflinePage(html_text, {}, engine=engine).apt
+    if expected is None:
+        expected = results['soup']
+    problems = []
+    for engine, apt in results.items():
+        if apt != expected:
+            for key in sorted(set(apt) | set(expected)):
+                if apt.get(key) != expected.get(key):
+                    problems.append((engine, key))
+    return problems
+
+
+# Markup of search pages the scanner must skip as AptSearchPageParser does:
+# a commented out ld+json block and page range, and a script with "<!--"
+search_page_quirks = {
+    'commented': ('<head>', '<head>\n<!-- <script type="application/ld+json">[1, 2]</script>\n'
+        '<span class="pageRange">Page 1 of 99</span> -->'),
+    'script': ('<script type="application/ld+json">', '<script>var c = "<!--";</script>\n'
+        '<script type="application/ld+json">')
+}
+
+
+def check_scanner(html_text):
+    """Scan a search page with scan_search_page() in chunks of several
+    sizes, with and without stop_early and page_count, and return a list of
+    (chunk size, stop_early, page_count) for which it did not use the
+    scanner or found other listings or page count than the parser."""
+    data = html_text.encode('utf-8')
+    expected = feed_chunks(AptSearchPageParser(), (html_text,))
+    problems = []
+    for size in (None, 1, 7, 4096):
+        for stop_early, page_count in ((False, False), (True, False), (True, True)):
+            chunks = data if size is None else [data[i:i + size] for i in range(0, len(data), size)]
+            found = scan_search_page(chunks, stop_early=stop_early, page_count=page_count)
+            # Stopping early may leave the page count out
+            pages = found.pages if not stop_early or page_count else expected.pages
+            if not isinstance(found, AptSearchPageScanner) or found.apartments != expected.apartments \
+                    or pages != expected.pages:
+                problems.append((size, stop_early, page_count))
+    return problems
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'example-apt-detail.json'
+    with open(path) as f:
+        apt = listing_fields(json.load(f))
+    problems = check_engines(render_detail_page(apt), with_available_dates(apt))
+    labelled = with_available_dates(with_availability_labels(apt))
+    problems += check_engines(render_detail_page(labelled), labelled)
+    for engine, key in problems:
+        print('%s: field %s differs' % (engine, key))
+    undated = set(unit['date_available'] for model in labelled['floorplans'] for unit in model['units']
+        if unit['available_on'] is None)
+    for label in sorted(undated):
+        print('No date for availability %r' % label)
+    summaries = [dict(((k, apt[k]) for k in ('name', 'street', 'city', 'state', 'zipcode')),
+        url='https://www.apartments.com/example-%d/%07x/' % (i, i)) for i in range(40)]
+    search_page = render_search_page(summaries, pages=3)
+    scan_problems = [('plain',) + p for p in check_scanner(search_page)]
+    for quirk, (old, new) in sorted(search_page_quirks.items()):
+        scan_problems += [(quirk,) + p for p in check_scanner(search_page.replace(old, new, 1))]
+    for quirk, size, stop_early, page_count in scan_problems:
+        print('Scanner differs on the %s search page (chunks of %s, stop_early=%s, page_count=%s)' % (
+            quirk, size or 'all', stop_early, page_count))
+    if problems or undated or scan_problems:
+        exit(1)
+    print('All engines match %s' % path)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+from common import data_dir, normalize
+
+import csv
+import getopt
+import math
+import os
+import sqlite3
+import sys
+import threading
+
+earth_radius_km = 6371.0088
+km_per_degree = math.pi * earth_radius_km / 180
+
+# Column names accepted by Geocoder.load_zipcodes() and load_addresses(),
+# including those of the Census Gazetteer ZCTA file
+_columns = {
+    'zipcode': ('zipcode', 'zip', 'zcta', 'geoid', 'postalcode'),
+    'lat': ('lat', 'latitude', 'intptlat'),
+    'lon': ('lon', 'lng', 'long', 'longitude', 'intptlong'),
+    'street': ('street', 'address', 'streetaddress'),
+    'city': ('city',),
+    'state': ('state',)
+}
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Great circle distance between two points in degrees."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * earth_radius_km * math.asin(min(1.0, math.sqrt(a)))
+
+
+def zip5(zipcode):
+    return (zipcode or '').strip()[:5]
+
+
+def address_key(street, city, state, zipcode):
+    """Normalized address, so that "123 Main St." matches "123 main st"."""
+    return normalize(' '.join((street or '', city or '', state or '', zip5(zipcode))))
+
+
+def _read_table(path, wanted):
+    """Rows of a CSV or tab separated file with a header naming `wanted`
+    columns (or an alias, see _columns), as dicts of those columns."""
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        header = f.readline()
+        delimiter = '\t' if '\t' in header else ','
+        names = [name.strip().lower().replace(' ', '').replace('_', '')
+            for name in next(csv.reader([header], delimiter=delimiter))]
+        positions = {}
+        for column in wanted:
+            for alias in _columns[column]:
+                if alias in names:
+                    positions[column] = names.index(alias)
+                    break
+            else:
+                raise ValueError('%s has no %s column' % (path, column))
+        for row in csv.reader(f, delimiter=delimiter):
+            if row:
+                yield dict((column, row[i].strip()) for column, i in positions.items())
+
+
+class Geocoder():
+    """Offline geocoder of listings: the coordinates of their street address
+    if it was geocoded before (see add_address() and load_addresses(), e.g.
+    the batch output of a geocoding service), else those of the center of
+    their ZIP code (see load_zipcodes(), e.g. the Census Gazetteer ZCTA
+    file). Never goes online.
+
+    Both tables are kept in SQLite; ZIP codes looked up are also kept in
+    memory, as thousands of listings share a few of them."""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(data_dir(), 'geocode.sqlite')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS zipcodes (zipcode TEXT PRIMARY KEY, lat REAL, lon REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS addresses (address TEXT PRIMARY KEY, lat REAL, lon REAL)')
+        self.db.commit()
+        self.zipcodes = {}
+
+    def add_zipcode(self, zipcode, lat, lon):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO zipcodes VALUES (?, ?, ?)', (zip5(zipcode), lat, lon))
+            self.db.commit()
+            self.zipcodes.pop(zip5(zipcode), None)
+
+    def add_address(self, street, city, state, zipcode, lat, lon):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO addresses VALUES (?, ?, ?)',
+                (address_key(street, city, state, zipcode), lat, lon))
+            self.db.commit()
+
+    def load_zipcodes(self, path):
+        """Import ZIP code centers from a file with zipcode, lat and lon
+        columns, or the Census Gazetteer ZCTA file (GEOID, INTPTLAT,
+        INTPTLONG). Returns how many were imported."""
+        rows = [(zip5(r['zipcode']), float(r['lat']), float(r['lon']))
+            for r in _read_table(path, ('zipcode', 'lat', 'lon'))]
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO zipcodes VALUES (?, ?, ?)', rows)
+            self.db.commit()
+            self.zipcodes.clear()
+        return len(rows)
+
+    def load_addresses(self, path):
+        """Import geocoded addresses from a file with street, city, state,
+        zipcode, lat and lon columns. Returns how many were imported."""
+        rows = [(address_key(r['street'], r['city'], r['state'], r['zipcode']), float(r['lat']),
+            float(r['lon'])) for r in _read_table(path, ('street', 'city', 'state', 'zipcode', 'lat', 'lon'))]
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO addresses VALUES (?, ?, ?)', rows)
+            self.db.commit()
+        return len(rows)
+
+    def zipcode(self, zipcode):
+        """(lat, lon) of the center of a ZIP code, None if unknown."""
+        zipcode = zip5(zipcode)
+        with self.lock:
+            if zipcode not in self.zipcodes:
+                self.zipcodes[zipcode] = self.db.execute('SELECT lat, lon FROM zipcodes WHERE zipcode = ?',
+                    (zipcode,)).fetchone()
+            return self.zipcodes[zipcode]
+
+    def locate(self, apt):
+        """(lat, lon, precision) of a listing, precision being 'address' or
+        'zipcode'; None if neither is known."""
+        with self.lock:
+            row = self.db.execute('SELECT lat, lon FROM addresses WHERE address = ?', (address_key(
+                apt.get('street'), apt.get('city'), apt.get('state'), apt.get('zipcode')),)).fetchone()
+        if row is not None:
+            return row[0], row[1], 'address'
+        row = self.zipcode(apt.get('zipcode'))
+        if row is not None:
+            return row[0], row[1], 'zipcode'
+        return None
+
+    def size(self):
+        """(addresses, ZIP codes)"""
+        with self.lock:
+            return (self.db.execute('SELECT COUNT(*) FROM addresses').fetchone()[0],
+                self.db.execute('SELECT COUNT(*) FROM zipcodes').fetchone()[0])
+
+
+_default_geocoder = None
+_default_lock = threading.Lock()
+
+
+def default_geocoder():
+    global _default_geocoder
+    with _default_lock:
+        if _default_geocoder is None:
+            _default_geocoder = Geocoder()
+        return _default_geocoder
+
+
+class GridIndex():
+    """Spatial index of points on a grid of square cells `cell_km` on a
+    side (in degrees of latitude; cells narrow towards the poles). A query
+    only visits the cells its bounding box overlaps, or the occupied cells
+    if there are fewer of those. Does not wrap around the antimeridian."""
+
+    def __init__(self, cell_km=1.0):
+        self.cell = cell_km / km_per_degree
+        # (row, column) -> [(lat, lon, item)]
+        self.cells = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell), math.floor(lon / self.cell)
+
+    def add(self, lat, lon, item):
+        self.cells.setdefault(self._cell(lat, lon), []).append((lat, lon, item))
+        self.count += 1
+
+    def _candidates(self, south, west, north, east):
+        (row0, col0), (row1, col1) = self._cell(south, west), self._cell(north, east)
+        if (row1 - row0 + 1) * (col1 - col0 + 1) > len(self.cells):
+            for (row, col), points in self.cells.items():
+                if row0 <= row <= row1 and col0 <= col <= col1:
+                    yield from points
+            return
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                points = self.cells.get((row, col))
+                if points is not None:
+                    yield from points
+
+    def bbox(self, south, west, north, east):
+        """Items inside a box of degrees, bounds included."""
+        return [item for lat, lon, item in self._candidates(south, west, north, east)
+            if south <= lat <= north and west <= lon <= east]
+
+    def within(self, lat, lon, radius_km):
+        """(distance in km, item) of the items within `radius_km` of a
+        point, nearest first."""
+        dlat = radius_km / km_per_degree
+        # Degrees of longitude are narrowest at the edge farthest from the equator
+        cos = math.cos(math.radians(min(90.0, abs(lat) + dlat)))
+        dlon = 180.0 if cos < 1e-9 else min(180.0, dlat / cos)
+        found = []
+        for plat, plon, item in self._candidates(lat - dlat, lon - dlon, lat + dlat, lon + dlon):
+            distance = distance_km(lat, lon, plat, plon)
+            if distance <= radius_km:
+                found.append((distance, item))
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+def help():
+    print('Usage: %s [options] [ZIP code...]' % sys.argv[0])
+    print('')
+    print('Manages the offline geocoding tables and prints the coordinates of ZIP codes.')
+    print('')
+    print('Options:')
+    print('  --zipcodes <file>: Import ZIP code centers (zipcode, lat, lon columns, or the Census')
+    print('    Gazetteer ZCTA file)')
+    print('  --addresses <file>: Import geocoded addresses (street, city, state, zipcode, lat, lon')
+    print('    columns)')
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['zipcodes=', 'addresses='])
+    except getopt.GetoptError as e:
+        print(e)
+        help()
+        exit(1)
+
+    geocoder = Geocoder()
+    for k, v in opts:
+        if k == '--zipcodes':
+            print('Imported %d ZIP codes' % geocoder.load_zipcodes(v))
+        elif k == '--addresses':
+            print('Imported %d addresses' % geocoder.load_addresses(v))
+        elif k == '-h':
+            help()
+            exit(0)
+
+    for zipcode in args:
+        found = geocoder.zipcode(zipcode)
+        print('%s: %s' % (zipcode, '%.6f,%.6f' % found if found is not None else 'unknown'))
+    if not opts and not args:
+        print('%d addresses, %d ZIP codes' % geocoder.size())
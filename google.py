@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from common import sess
+import common
 import json
 import re
 import sys
@@ -8,8 +8,24 @@ import sys
 fid_pattern = re.compile(r'data\-fid\=\"([0-9a-fx:]+)\"')
 
 
+def search_url(keyword):
+    return 'https://google.com/search?q=' + keyword
+
+
 def search(keyword):
-    resp = sess.get(url='https://google.com/search?q=' + keyword)
+    resp = common.session().get(url=search_url(keyword))
+    # A throttled search has no feature id either, but must not pass for a
+    # place without one
+    resp.raise_for_status()
+    return resp.text
+
+
+async def search_async(keyword, session=None):
+    if session is None:
+        import aio
+        session = aio.get_session()
+    resp = await session.get(search_url(keyword))
+    resp.raise_for_status()
     return resp.text
 
 
@@ -20,7 +36,7 @@ def extract_feature_id(body):
     return match.group(1)
 
 
-def load_comments(fid, **kwargs):
+def comments_url(fid, **kwargs):
     query = {
         'feature_id': fid,
         'review_source': 'All reviews',
@@ -41,18 +57,40 @@ def load_comments(fid, **kwargs):
     for k, v in query.items():
         params.append('%s:%s' % (k, v))
     params_str = ','.join(params)
-    # Send request
-    resp = sess.get(url='https://www.google.com/async/reviewDialog?async=' + params_str)
-    resp_json_text = resp.text[5:]
-    reviews_obj = json.loads(resp_json_text)
-    if 'other_user_review' not in reviews_obj['localReviewsDialogProto']['reviews']:
+    return 'https://www.google.com/async/reviewDialog?async=' + params_str
+
+
+def parse_comments(text):
+    """Reviews and next page token of a review dialog response. Raises
+    ValueError if `text` is not one, e.g. a captcha page."""
+    resp_json_text = text[5:]
+    try:
+        reviews_obj = json.loads(resp_json_text)['localReviewsDialogProto']['reviews']
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError('Not a review dialog response: %r' % text[:80]) from e
+    if 'other_user_review' not in reviews_obj:
         return [], ''
 
-    reviews = reviews_obj['localReviewsDialogProto']['reviews']['other_user_review']
-    next_page = reviews_obj['localReviewsDialogProto']['reviews']['next_page_token']
+    reviews = reviews_obj['other_user_review']
+    next_page = reviews_obj['next_page_token']
     return reviews, next_page
 
 
+def load_comments(fid, **kwargs):
+    resp = common.session().get(url=comments_url(fid, **kwargs))
+    resp.raise_for_status()
+    return parse_comments(resp.text)
+
+
+async def load_comments_async(fid, session=None, **kwargs):
+    if session is None:
+        import aio
+        session = aio.get_session()
+    resp = await session.get(comments_url(fid, **kwargs))
+    resp.raise_for_status()
+    return parse_comments(resp.text)
+
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print('Please include some keywords.')
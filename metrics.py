@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+from urllib.parse import urlsplit
+
+import json
+import sys
+import threading
+import time
+
+
+class _Timer():
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics._observe(self.name, time.perf_counter() - self.start, self.labels)
+        return False
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '[%s]' % ','.join('%s=%s' % item for item in sorted(labels.items()))
+
+
+class Metrics():
+    """Thread-safe counters and timers, each identified by a name and labels
+    such as stage=... or host=...
+
+        metrics.count('http_bytes', 5120, host='www.apartments.com')
+        with metrics.timer('detail.parse', engine='soup'):
+            ...
+
+    Recording is a dict update under a lock, cheap enough for every request
+    and parse stage (not for every tag). The numbers can be exported as JSON
+    log lines (log()), Prometheus text (prometheus(), serve()) or a human
+    readable summary()."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            # (name, labels) -> [count, total seconds, max seconds]
+            self.timers = {}
+            self.start = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def count(self, name, n=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds, **labels):
+        self._observe(name, seconds, labels)
+
+    def _observe(self, name, seconds, labels):
+        key = self._key(name, labels)
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    def timer(self, name, **labels):
+        """Context manager adding the time spent in its block to `name`."""
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        """Every metric as a dict: counters have a 'value', timers a 'count',
+        'seconds' (total) and 'max_seconds'."""
+        with self.lock:
+            counters = list(self.counters.items())
+            timers = [(key, list(value)) for key, value in self.timers.items()]
+        metrics = []
+        for (name, labels), value in sorted(counters):
+            metrics.append({'type': 'counter', 'name': name, 'labels': dict(labels), 'value': value})
+        for (name, labels), (count, total, longest) in sorted(timers):
+            metrics.append({'type': 'timer', 'name': name, 'labels': dict(labels), 'count': count,
+                'seconds': total, 'max_seconds': longest})
+        return metrics
+
+    def log(self, out=sys.stderr, **fields):
+        """Write every metric to `out` as one JSON object per line, with
+        `fields` (e.g. crawl='...') added to each."""
+        now = time.time()
+        for metric in self.snapshot():
+            metric.update(fields)
+            metric['time'] = now
+            print(json.dumps(metric), file=out)
+        out.flush()
+
+    def prometheus(self, prefix='apartment_finder'):
+        """The metrics in the Prometheus text exposition format. Timers become
+        summaries (<name>_seconds_count and _sum) plus a <name>_seconds_max
+        gauge."""
+        def series(name, labels, value):
+            if labels:
+                name += '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+            return '%s %s' % (name, repr(float(value)) if isinstance(value, float) else value)
+
+        lines = []
+        maxima = []
+        typed = set()
+        for metric in self.snapshot():
+            name = '%s_%s' % (prefix, metric['name'].replace('.', '_'))
+            if metric['type'] == 'counter':
+                name += '_total'
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s counter' % name)
+                lines.append(series(name, metric['labels'], metric['value']))
+            else:
+                name += '_seconds'
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE %s summary' % name)
+                lines.append(series(name + '_count', metric['labels'], metric['count']))
+                lines.append(series(name + '_sum', metric['labels'], metric['seconds']))
+                maxima.append(series(name + '_max', metric['labels'], metric['max_seconds']))
+        # The longest time of every timer is a gauge of its own
+        last = None
+        for line in maxima:
+            name = line.split('{')[0].split(' ')[0]
+            if name != last:
+                last = name
+                lines.append('# TYPE %s gauge' % name)
+            lines.append(line)
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, address=''):
+        """Serve prometheus() over HTTP on a daemon thread; returns the server."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def summary(self):
+        """Per-crawl summary: time per stage and traffic per host."""
+        snapshot = self.snapshot()
+        elapsed = time.time() - self.start
+        lines = ['Crawl summary (%.1fs):' % elapsed]
+        stages = [m for m in snapshot if m['type'] == 'timer' and m['name'] != 'http']
+        if stages:
+            lines.append('  %-52s %8s %10s %10s %10s' % ('stage', 'count', 'total s', 'mean ms', 'max ms'))
+            for m in sorted(stages, key=lambda m: -m['seconds']):
+                label = m['name'] + _labels(m['labels'])
+                lines.append('  %-52s %8d %10.2f %10.1f %10.1f' % (label, m['count'], m['seconds'],
+                    m['seconds'] / m['count'] * 1000, m['max_seconds'] * 1000))
+        other = [m for m in snapshot if m['type'] == 'counter' and not m['name'].startswith('http')]
+        if other:
+            lines.append('  ' + ', '.join('%s%s: %d' % (m['name'], _labels(m['labels']), m['value'])
+                for m in other))
+        hosts = {}
+        for m in snapshot:
+            host = m['labels'].get('host')
+            if host is None or not m['name'].startswith('http'):
+                continue
+            counts = hosts.setdefault(host, {})
+            if m['type'] == 'timer':
+                counts['latency'] = m['seconds'] / m['count']
+            elif m['name'] == 'http_responses':
+                if m['labels']['status'] not in ('2xx', '3xx'):
+                    counts['errors'] = counts.get('errors', 0) + m['value']
+            else:
+                counts[m['name']] = m['value']
+        if hosts:
+            lines.append('  %-28s %8s %10s %10s %10s %8s %8s' % ('host', 'requests', 'MiB',
+                'latency ms', 'cache hit', 'retries', 'errors'))
+            for host, counts in sorted(hosts.items()):
+                requests = counts.get('http_requests', 0)
+                hits = counts.get('http_cache_hits', 0)
+                lines.append('  %-28s %8d %10.2f %10.1f %9.0f%% %8d %8d' % (host, requests,
+                    counts.get('http_bytes', 0) / 2 ** 20, counts.get('latency', 0) * 1000,
+                    100.0 * hits / requests if requests else 0, counts.get('http_retries', 0),
+                    counts.get('errors', 0)))
+        return '\n'.join(lines)
+
+
+# Metrics of this process, recorded by the fetch, parse and enrichment code
+registry = Metrics()
+
+count = registry.count
+observe = registry.observe
+timer = registry.timer
+
+
+def _host(url):
+    return urlsplit(url).netloc.lower()
+
+
+def record_request(url, status, seconds=None, nbytes=None, from_cache=False, retries=0):
+    """Record one HTTP request to the host of `url`."""
+    host = _host(url)
+    count('http_requests', host=host)
+    count('http_responses', host=host, status='%dxx' % (status // 100))
+    if from_cache:
+        count('http_cache_hits', host=host)
+    elif seconds is not None:
+        observe('http', seconds, host=host)
+    if retries:
+        count('http_retries', retries, host=host)
+    if nbytes is not None:
+        count('http_bytes', nbytes, host=host)
+
+
+def record_response(resp, *args, **kwargs):
+    """requests response hook recording every response: cache hits, retries
+    (of control.FlowControlAdapter or urllib3), latency, status and, unless
+    the response is streamed (see record_stream()), the bytes of the body."""
+    retries = getattr(resp, 'retries', None)
+    if retries is None:
+        history = getattr(resp.raw, 'retries', None)
+        retries = len(history.history) if history is not None else 0
+    record_request(resp.url, resp.status_code, resp.elapsed.total_seconds(),
+        None if kwargs.get('stream') else len(resp.content),
+        getattr(resp, 'from_cache', False), retries)
+
+
+def record_stream(resp, nbytes):
+    """Count the bytes read from a streamed response."""
+    count('http_bytes', nbytes, host=_host(resp.url))
+
+
+def save(path, **fields):
+    """Append the metrics of this process to `path` as JSON lines, see
+    Metrics.log(); '-' writes them to stderr."""
+    if path == '-':
+        registry.log(sys.stderr, **fields)
+        return
+    with open(path, 'a') as f:
+        registry.log(f, **fields)
+
+
+def install(session):
+    """Record every response of a requests session."""
+    if record_response not in session.hooks['response']:
+        session.hooks['response'].append(record_response)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+from datetime import date, timedelta
+
+import re
+
+# Locale-free parsers for the numbers and dates of a listing page. Every
+# pattern is compiled once at import and no function keeps state, so they
+# are safe to call from any number of threads, unlike locale.atoi which
+# depends on the process-wide locale set by locale.setlocale.
+
+_months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+_month_numbers = dict((name, i + 1) for i, name in enumerate(_months))
+
+# "$2,940" or "2,940"; group 1 is the digits with their thousands separators
+_number = re.compile(r'\$?\s*(\d[\d,]*)')
+# "$2,940 /mo" anywhere in a unit's price text
+_price = re.compile(r'\$(\d[\d,]*)')
+# The label of a unit's availability: "Now" or a month, with its day if any
+# ("Feb. 22", "May 22", "June 5")
+_availability = re.compile(r'(Now|%s)(\w*\.?\s+\d{1,2})?' % '|'.join(_months))
+_month_day = re.compile(r'(%s)\w*\.?\s+(\d{1,2})' % '|'.join(_months))
+_range_separator = ' - '
+# "2 weeks ago", "a month ago", "Edited 3 days ago"
+_ago = re.compile(r'(\d+|an?)\s+(minute|hour|day|week|month|year)s?\s+ago')
+_unit_days = {'minute': 0, 'hour': 0, 'day': 1, 'week': 7, 'month': 30, 'year': 365}
+
+
+def parse_int(text):
+    """An integer written with thousands separators and an optional dollar
+    sign, e.g. "$2,940". Raises ValueError if `text` is not one."""
+    match = _number.fullmatch(text.strip())
+    if match is None:
+        raise ValueError('Not a number: %r' % text)
+    return int(match.group(1).replace(',', ''))
+
+
+def price_range(text):
+    """(lower, upper) rent of "$2,940 - $5,370" or "$2,940"; (None, None)
+    when the rent is not given, e.g. "Call for Rent"."""
+    prices = text.split(_range_separator)
+    if len(prices) == 1:
+        try:
+            lower = upper = parse_int(prices[0])
+        except ValueError:
+            lower = upper = None
+        return lower, upper
+    return parse_int(prices[0]), parse_int(prices[1])
+
+
+def bed_range(text):
+    """(lower, upper) bedrooms of "Studio - 3 bd" or "2 bd"; studios are 0."""
+    rooms = text.split(_range_separator)
+    lower = 0 if rooms[0].lower() == 'studio' else int(rooms[0][0])
+    upper = int(rooms[1][0]) if len(rooms) > 1 else lower
+    return lower, upper
+
+
+def bath_range(text):
+    """(lower, upper) bathrooms of "1 - 2 ba" or "1 ba"."""
+    baths = text.split(_range_separator)
+    lower = int(baths[0][0])
+    upper = int(baths[1][0]) if len(baths) > 1 else lower
+    return lower, upper
+
+
+def area_range(text):
+    """(lower, upper) square feet of "580 - 1,317 sq ft" or "580 sq ft"."""
+    areas = text.replace(' sq ft', '').split(_range_separator)
+    lower = parse_int(areas[0])
+    upper = parse_int(areas[1]) if len(areas) > 1 else lower
+    return lower, upper
+
+
+def unit_price(text):
+    """Rent of a unit from the text of its price column, e.g.
+    "price $2,940"."""
+    match = _price.search(text)
+    if match is None:
+        raise ValueError('No price in %r' % text)
+    return int(match.group(1).replace(',', ''))
+
+
+def availability(text):
+    """The availability label of a unit, "Now" or e.g. "Feb. 22", from the
+    text of its availability column; the stripped text if it has neither."""
+    match = _availability.search(text)
+    if match is None:
+        return text.strip()
+    return match.group(0)
+
+
+def available_date(text, today=None):
+    """Day a unit is available from its availability text ("Now", "Feb. 22",
+    "Available Jan 5"), as a date on or after `today` (default: the current
+    day; a month/day more than a month in the past is taken as next year).
+    None if the text has no date."""
+    if not text:
+        return None
+    if today is None:
+        today = date.today()
+    if 'now' in text.lower():
+        return today
+    match = _month_day.search(text)
+    if match is None:
+        return None
+    month = _month_numbers[match.group(1)]
+    day = int(match.group(2))
+    try:
+        avail = date(today.year, month, day)
+        if (today - avail).days > 31:
+            avail = date(today.year + 1, month, day)
+    except ValueError:
+        return None
+    return avail
+
+
+def published_date(text, today=None):
+    """Day a Google review was published from its relative date ("2 weeks
+    ago", "a year ago"), counted back from `today` (default: the current
+    day). Months count as 30 days and years as 365, so the result is only as
+    precise as the text. None if the text is not a relative date."""
+    match = _ago.search(text.lower()) if text else None
+    if match is None:
+        return None
+    if today is None:
+        today = date.today()
+    count = 1 if match.group(1) in ('a', 'an') else int(match.group(1))
+    return today - timedelta(days=count * _unit_days[match.group(2)])
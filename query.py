@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+
+from common import normalize
+from datetime import date
+from export import read_records
+from geo import Geocoder, GridIndex, distance_km
+from parsing import available_date
+
+import getopt
+import json
+import numpy as np
+import records
+import sys
+
+# Numeric columns of a UnitTable; missing values are NaN (NaT for dates)
+numeric_columns = ('rent', 'beds', 'baths', 'sqft', 'price_per_sqft', 'available')
+
+
+class UnitTable():
+    """Columnar in-memory table of every unit of a set of listings, for
+    filtering, sorting and aggregating crawled listings locally.
+
+    Each row is a unit (a floor plan without listed units is one row);
+    floor plans repeated on a page are kept once. The numeric columns are
+    numpy arrays: 'rent', 'beds', 'baths', 'sqft', 'price_per_sqft'
+    (float64, NaN when unknown) and 'available' (datetime64[D], NaT when
+    unknown). 'listing' and 'floorplan' index
+    `listings` and `floorplans`. Amenities of a listing apply to all its
+    units and those of a floor plan to its own units; they are indexed by
+    the words they contain. Listings with coordinates are indexed by
+    location (see geo_index())."""
+
+    def __init__(self):
+        self.listings = []
+        self.floorplans = []
+        self.units = []
+        # Per listing: its (first, last + 1) rows and (lat, lon) or None
+        self.listing_rows = []
+        self.locations = []
+        self.columns = {}
+        # normalized amenity -> sorted row indices
+        self.amenity_rows = {}
+        # word -> normalized amenities containing it
+        self.amenity_words = {}
+        self._geo_index = None
+
+    @classmethod
+    def from_apts(cls, apts, today=None, geocoder=None):
+        """Build the table from `apt` dicts (ApartmentPage.apt). Units keep
+        the 'available_on' date resolved when they were crawled; those of
+        older records without one are resolved relative to `today`.
+        Listings without 'lat' and 'lon' are located with `geocoder` (a
+        geo.Geocoder) if given."""
+        if today is None:
+            today = date.today()
+        table = cls()
+        rent, beds, baths, sqft, available, listing, floorplan = [], [], [], [], [], [], []
+        # normalized amenity -> ([start], [end]) of the row ranges having it
+        amenity_ranges = {}
+        keys = {}
+        days = {}
+
+        def index_amenities(amenities, start, end):
+            for amenity in amenities:
+                key = keys.get(amenity)
+                if key is None:
+                    key = keys[amenity] = normalize(amenity)
+                if key:
+                    starts, ends = amenity_ranges.setdefault(key, ([], []))
+                    starts.append(start)
+                    ends.append(end)
+
+        for apt in apts:
+            lid = len(table.listings)
+            table.listings.append(apt)
+            first = len(rent)
+            seen = set()
+            for model in apt.get('floorplans', []):
+                # Floor plans are repeated on the page, once per tab
+                if model['name'] in seen:
+                    continue
+                seen.add(model['name'])
+                fid = len(table.floorplans)
+                table.floorplans.append(model)
+                start = len(rent)
+                units = model.get('units') or [{'unit': None, 'price': model.get('min_rent'),
+                    'date_available': model.get('date_available')}]
+                for unit in units:
+                    table.units.append(unit)
+                    rent.append(unit['price'])
+                    beds.append(model.get('beds'))
+                    baths.append(model.get('baths'))
+                    sqft.append(model.get('min_area_sqft'))
+                    if unit.get('available_on') is not None:
+                        available.append(date.fromisoformat(unit['available_on']))
+                    else:
+                        text = unit['date_available']
+                        if text not in days:
+                            days[text] = available_date(text, today)
+                        available.append(days[text])
+                    listing.append(lid)
+                    floorplan.append(fid)
+                index_amenities(model.get('amenities', []), start, len(rent))
+            for amenities in apt.get('amenities', {}).values():
+                index_amenities(amenities, first, len(rent))
+            table.listing_rows.append((first, len(rent)))
+            location = None
+            if apt.get('lat') is not None and apt.get('lon') is not None:
+                location = (apt['lat'], apt['lon'])
+            elif geocoder is not None:
+                found = geocoder.locate(apt)
+                if found is not None:
+                    location = found[:2]
+            table.locations.append(location)
+
+        def floats(values):
+            return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+        cols = table.columns
+        cols['rent'] = floats(rent)
+        cols['beds'] = floats(beds)
+        cols['baths'] = floats(baths)
+        cols['sqft'] = floats(sqft)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cols['price_per_sqft'] = np.where(cols['sqft'] > 0, cols['rent'] / cols['sqft'], np.nan)
+        cols['available'] = np.array(available, dtype='datetime64[D]')
+        cols['listing'] = np.array(listing, dtype=np.int32)
+        cols['floorplan'] = np.array(floorplan, dtype=np.int32)
+
+        for key, (starts, ends) in amenity_ranges.items():
+            # Rows covered by any range: running sum of +1 at starts, -1 at ends
+            delta = np.zeros(len(rent) + 1, dtype=np.int32)
+            np.add.at(delta, starts, 1)
+            np.add.at(delta, ends, -1)
+            table.amenity_rows[key] = np.flatnonzero(np.cumsum(delta[:-1]) > 0).astype(np.int32)
+            for word in key.split():
+                table.amenity_words.setdefault(word, set()).add(key)
+        return table
+
+    @classmethod
+    def from_store(cls, store, today=None, geocoder=None):
+        apts = []
+        for url in store.urls():
+            apt = records.Listing.from_dict(store.get(url))
+            apt.setdefault('url', url)
+            apts.append(apt)
+        return cls.from_apts(apts, today, geocoder)
+
+    def __len__(self):
+        return len(self.units)
+
+    def amenities(self, term):
+        """Indexed amenities containing every word of `term`, e.g. "washer
+        dryer" finds "In Unit Washer & Dryer" and "Washer/Dryer"."""
+        words = normalize(term).split()
+        if not words:
+            return set()
+        keys = None
+        for word in words:
+            found = self.amenity_words.get(word, set())
+            keys = found if keys is None else keys & found
+        return keys
+
+    def amenity_mask(self, term):
+        """Boolean mask of the rows having an amenity matching `term`."""
+        mask = np.zeros(len(self), dtype=bool)
+        for key in self.amenities(term):
+            mask[self.amenity_rows[key]] = True
+        return mask
+
+    def geo_index(self):
+        """geo.GridIndex of the listings with a location, made on first use."""
+        if self._geo_index is None:
+            index = GridIndex()
+            for lid, location in enumerate(self.locations):
+                if location is not None:
+                    index.add(location[0], location[1], lid)
+            self._geo_index = index
+        return self._geo_index
+
+    def listing_mask(self, listings):
+        """Boolean mask of the rows of the given listings."""
+        mask = np.zeros(len(self), dtype=bool)
+        for lid in listings:
+            start, end = self.listing_rows[lid]
+            mask[start:end] = True
+        return mask
+
+    def near_mask(self, lat, lon, km):
+        """Boolean mask of the rows of the listings within `km` of a point."""
+        return self.listing_mask(lid for _, lid in self.geo_index().within(lat, lon, km))
+
+    def bbox_mask(self, south, west, north, east):
+        """Boolean mask of the rows of the listings inside a box of degrees."""
+        return self.listing_mask(self.geo_index().bbox(south, west, north, east))
+
+    def query(self):
+        return Query(self)
+
+
+class Query():
+    """Immutable selection of the rows of a UnitTable. where() narrows it down,
+    sort() and limit() order it; rows are only materialized by indices(),
+    records() and the aggregates."""
+
+    def __init__(self, table, mask=None, order=None, descending=False, count=None, origin=None):
+        self.table = table
+        self.mask = mask if mask is not None else np.ones(len(table), dtype=bool)
+        self.order = order
+        self.descending = descending
+        self.max_rows = count
+        # (lat, lon) the records tell their distance to
+        self.origin = origin
+
+    def _derive(self, **kwargs):
+        args = {'mask': self.mask, 'order': self.order, 'descending': self.descending,
+            'count': self.max_rows, 'origin': self.origin}
+        args.update(kwargs)
+        return Query(self.table, **args)
+
+    def where(self, min_rent=None, max_rent=None, min_beds=None, max_beds=None, studio=False,
+            min_baths=None, max_baths=None, min_sqft=None, max_sqft=None,
+            available_before=None, available_after=None, amenities=(), near=None, bbox=None, mask=None):
+        """Keep the rows matching every given criterion. Bounds are
+        inclusive and rows with an unknown value fail a bound on it. Dates
+        are `datetime.date`s or 'YYYY-MM-DD' strings; `amenities` are terms
+        that must all match (see UnitTable.amenities). `near` is (lat, lon,
+        km) and `bbox` (south, west, north, east); listings without a
+        location fail both."""
+        cols = self.table.columns
+        new = self.mask.copy()
+        for column, lower, upper in (('rent', min_rent, max_rent), ('beds', min_beds, max_beds),
+                ('baths', min_baths, max_baths), ('sqft', min_sqft, max_sqft)):
+            if lower is not None:
+                new &= cols[column] >= lower
+            if upper is not None:
+                new &= cols[column] <= upper
+        if studio:
+            new &= cols['beds'] == 0
+        if available_before is not None:
+            new &= cols['available'] <= np.datetime64(available_before, 'D')
+        if available_after is not None:
+            new &= cols['available'] >= np.datetime64(available_after, 'D')
+        for term in amenities:
+            new &= self.table.amenity_mask(term)
+        if near is not None:
+            new &= self.table.near_mask(*near)
+        if bbox is not None:
+            new &= self.table.bbox_mask(*bbox)
+        if mask is not None:
+            new &= mask
+        return self._derive(mask=new, origin=tuple(near[:2]) if near is not None else self.origin)
+
+    def sort(self, column, descending=False):
+        """Order by a numeric column; rows with an unknown value come last."""
+        if column not in numeric_columns:
+            raise ValueError('Cannot sort by %s' % column)
+        return self._derive(order=column, descending=descending)
+
+    def limit(self, count):
+        return self._derive(count=count)
+
+    def indices(self):
+        rows = np.flatnonzero(self.mask)
+        if self.order is not None:
+            values = self.table.columns[self.order][rows]
+            if self.descending:
+                # Negating keeps NaN/NaT last under a stable ascending sort
+                if values.dtype.kind == 'M':
+                    values = -values.astype(np.int64)
+                    values[np.isnat(self.table.columns[self.order][rows])] = np.iinfo(np.int64).max
+                else:
+                    values = -values
+            rows = rows[np.argsort(values, kind='stable')]
+        if self.max_rows is not None:
+            rows = rows[:self.max_rows]
+        return rows
+
+    def count(self):
+        return int(np.count_nonzero(self.mask))
+
+    def values(self, column):
+        return self.table.columns[column][self.indices()]
+
+    def percentiles(self, column='price_per_sqft', q=(10, 25, 50, 75, 90)):
+        """Percentiles of a numeric column over the selected rows with a
+        known value, as {q: value}; empty if there are none."""
+        values = self.table.columns[column][self.mask]
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return {}
+        return dict(zip(q, np.percentile(values, q).tolist()))
+
+    def describe(self, column='rent'):
+        values = self.table.columns[column][self.mask]
+        values = values[~np.isnan(values)]
+        if len(values) == 0:
+            return {'count': 0}
+        return {
+            'count': len(values),
+            'min': float(values.min()),
+            'mean': float(values.mean()),
+            'max': float(values.max())
+        }
+
+    def records(self):
+        """The selected units as flat dicts, in order, with their
+        'distance_km' to the point of a `near` criterion."""
+        table = self.table
+        cols = table.columns
+        for row in self.indices():
+            lid = cols['listing'][row]
+            apt = table.listings[lid]
+            model = table.floorplans[cols['floorplan'][row]]
+            unit = table.units[row]
+            available = cols['available'][row]
+            record = {
+                'name': apt.get('name'),
+                'url': apt.get('url'),
+                'floorplan': model.get('name'),
+                'unit': unit['unit'],
+                'rent': unit['price'],
+                'beds': model.get('beds'),
+                'baths': model.get('baths'),
+                'sqft': model.get('min_area_sqft'),
+                'available': str(available) if not np.isnat(available) else None
+            }
+            location = table.locations[lid]
+            if self.origin is not None and location is not None:
+                record['distance_km'] = round(distance_km(self.origin[0], self.origin[1], *location), 2)
+            yield record
+
+
+def help():
+    print('Usage: %s [options] [filters...] [listings.ndjson...]' % sys.argv[0])
+    print('')
+    print('Filters crawled listings (one JSON record per line, e.g. the output of')
+    print('crawler.py) and prints the matching units as JSON lines.')
+    print('')
+    print('Options:')
+    print('  --store: Query the listing store instead of JSON records')
+    print('  --sort <rent | beds | baths | sqft | price_per_sqft | available>: Sort units')
+    print('  --desc: Sort in descending order')
+    print('  -n, --limit <N>: Print at most N units')
+    print('  --stats: Print the count, rent and $/sqft percentiles instead of units')
+    print('Filters:')
+    print('  -b, --min-beds <N>, -B, --max-beds <N | studio>: Number of bedrooms')
+    print('  -r, --min-rent <N>, -R, --max-rent <N>: Monthly rent')
+    print('  --min-baths <N>, --max-baths <N>: Number of bathrooms')
+    print('  --min-sqft <N>, --max-sqft <N>: Area in square feet')
+    print('  --before <YYYY-MM-DD>, --after <YYYY-MM-DD>: Date available')
+    print('  -a, --amenity <words>: Require an amenity with these words, e.g. "washer dryer"')
+    print('                         (may be repeated)')
+    print('  --near <lat,lon | ZIP code>: Listings within --within km of a point (see geo.py)')
+    print('  --within <km>: Radius of --near (default: 5)')
+    print('  --bbox <south,west,north,east>: Listings inside a box of degrees')
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hb:B:r:R:a:n:', ['min-beds=', 'max-beds=',
+            'min-rent=', 'max-rent=', 'min-baths=', 'max-baths=', 'min-sqft=', 'max-sqft=',
+            'before=', 'after=', 'amenity=', 'near=', 'within=', 'bbox=', 'store', 'sort=', 'desc', 'limit=',
+            'stats'])
+    except getopt.GetoptError as e:
+        print(e)
+        help()
+        exit(1)
+
+    criteria = {'amenities': []}
+    near = None
+    within = 5.0
+    use_store = False
+    sort = None
+    descending = False
+    limit = None
+    stats = False
+    for k, v in opts:
+        if k in ('-b', '--min-beds'):
+            criteria['min_beds'] = int(v)
+        elif k in ('-B', '--max-beds'):
+            if v.lower() == 'studio':
+                criteria['studio'] = True
+            else:
+                criteria['max_beds'] = int(v)
+        elif k in ('-r', '--min-rent'):
+            criteria['min_rent'] = int(v)
+        elif k in ('-R', '--max-rent'):
+            criteria['max_rent'] = int(v)
+        elif k in ('--min-baths', '--max-baths', '--min-sqft', '--max-sqft'):
+            criteria[k[2:].replace('-', '_')] = float(v)
+        elif k == '--before':
+            criteria['available_before'] = v
+        elif k == '--after':
+            criteria['available_after'] = v
+        elif k in ('-a', '--amenity'):
+            criteria['amenities'].append(v)
+        elif k == '--near':
+            near = v
+        elif k == '--within':
+            within = float(v)
+        elif k == '--bbox':
+            criteria['bbox'] = tuple(float(x) for x in v.split(','))
+        elif k == '--store':
+            use_store = True
+        elif k == '--sort':
+            sort = v
+        elif k == '--desc':
+            descending = True
+        elif k in ('-n', '--limit'):
+            limit = int(v)
+        elif k == '--stats':
+            stats = True
+        elif k == '-h':
+            help()
+            exit(0)
+
+    geocoder = None
+    if near is not None or 'bbox' in criteria:
+        geocoder = Geocoder()
+        if near is not None:
+            if ',' in near:
+                point = tuple(float(x) for x in near.split(','))
+            else:
+                point = geocoder.zipcode(near)
+                if point is None:
+                    print('Unknown ZIP code %s, see geo.py --zipcodes' % near)
+                    exit(1)
+            criteria['near'] = (point[0], point[1], within)
+
+    if use_store:
+        from store import ListingStore
+        table = UnitTable.from_store(ListingStore(), geocoder=geocoder)
+    else:
+        table = UnitTable.from_apts(read_records(args), geocoder=geocoder)
+    q = table.query().where(**criteria)
+    if stats:
+        print(json.dumps({
+            'units': q.count(),
+            'listings': len(np.unique(q.table.columns['listing'][q.mask])),
+            'rent': q.describe('rent'),
+            'price_per_sqft': q.percentiles('price_per_sqft')
+        }))
+        exit(0)
+    if sort is not None:
+        q = q.sort(sort, descending)
+    if limit is not None:
+        q = q.limit(limit)
+    for record in q.records():
+        print(json.dumps(record))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+from collections.abc import MutableMapping
+
+import getopt
+import json
+import sys
+
+
+# Strings up to this length (names, amenities, dates) are interned, so the
+# copies repeated across floor plans and listings share one object
+intern_max = 64
+
+
+def _compact(value):
+    if isinstance(value, str):
+        return sys.intern(value) if len(value) <= intern_max else value
+    if isinstance(value, list):
+        return [_compact(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, _compact(v)) for k, v in value.items())
+    return value
+
+
+class Record(MutableMapping):
+    """Compact replacement for the dicts ApartmentPage.apt is made of: a
+    slotted object with one slot per known key, behaving like the dict it
+    was made from. Keys that are not set are absent, as in the dict; keys
+    outside `fields` go into a dict allocated only when needed. Lists of
+    nested dicts listed in `nested` are converted to their record type and
+    short strings are interned."""
+
+    __slots__ = ('_extra',)
+    fields = ()
+    nested = {}
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, d):
+        """Convert `d` and its nested dicts; records are returned as is."""
+        if isinstance(d, cls):
+            return d
+        record = cls()
+        for key, value in d.items():
+            if key in cls.nested and value is not None:
+                value = [cls.nested[key].from_dict(v) for v in value]
+            else:
+                value = _compact(value)
+            record[key] = value
+        return record
+
+    def to_dict(self):
+        """Plain dict with the same keys, nested records included. Keys come
+        in the order of `fields`, then the others in the order they were set."""
+        d = {}
+        for key, value in self.items():
+            if key in self.nested and value is not None:
+                value = [v.to_dict() if isinstance(v, Record) else v for v in value]
+            d[key] = value
+        return d
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.fields:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self._extra is None or key not in self._extra:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for key in self.fields:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, Record)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self.items()))
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self._extra = None
+        for key, value in type(self).from_dict(state).items():
+            self[key] = value
+
+
+class Unit(Record):
+    __slots__ = ('unit', 'price', 'date_available', 'available_on')
+    fields = __slots__
+
+
+class Review(Record):
+    __slots__ = ('author', 'publish_date', 'review_text', 'rating', 'translated', 'thumbs_up_count')
+    fields = __slots__
+
+
+class Floorplan(Record):
+    __slots__ = ('name', 'min_rent', 'max_rent', 'beds', 'baths', 'min_area_sqft', 'max_area_sqft',
+        'amenities', 'leasing_term', 'deposit', 'date_available', 'units')
+    fields = __slots__
+    nested = {'units': Unit}
+
+
+class Listing(Record):
+    __slots__ = ('url', 'name', 'street', 'city', 'state', 'zipcode', 'lat', 'lon', 'geo_precision',
+        'min_rent', 'max_rent', 'min_beds', 'max_beds', 'min_baths', 'max_baths', 'min_area_sqft',
+        'max_area_sqft', 'floorplans', 'about', 'features', 'tel', 'website', 'amenities', 'reviews')
+    fields = __slots__
+    nested = {'floorplans': Floorplan, 'reviews': Review}
+
+
+def json_default(obj):
+    """`default` for json.dump(s) to serialize records nested anywhere."""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+
+def dumps(obj, **kwargs):
+    return json.dumps(obj, default=json_default, **kwargs)
+
+
+def loads(text):
+    """Parse one JSON `apt` object into a Listing."""
+    return Listing.from_dict(json.loads(text))
+
+
+def help():
+    print('Usage: %s [options] [listings.ndjson]' % sys.argv[0])
+    print('')
+    print('Reports the memory taken by listings (one JSON record per line, e.g. the output')
+    print('of crawler.py; stdin if no file is given) as dicts and as records.')
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h')
+    except getopt.GetoptError as e:
+        print(e)
+        help()
+        exit(1)
+
+    for k, v in opts:
+        if k == '-h':
+            help()
+            exit(0)
+
+    import tracemalloc
+    f = open(args[0]) if args else sys.stdin
+    lines = [line for line in f if line.strip()]
+    for name, load in (('dicts', json.loads), ('records', loads)):
+        tracemalloc.start()
+        apts = [load(line) for line in lines]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('%s: %d listings, %.1f KiB' % (name, len(apts), size / 1024))
+        del apts
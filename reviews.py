@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+from common import TokenBucket
+from fidcache import FidCache
+
+import google
+import metrics
+import random
+import threading
+import time
+
+
+def review_key(review):
+    """Identity of a review, from either a raw Google review or one filtered
+    by ApartmentPage._filter_reviews."""
+    author = review.get('author_real_name', review.get('author'))
+    text = review.get('review_text', {}).get('full_html')
+    return author, text
+
+
+class ReviewFetcher():
+    """Fetches Google reviews under one politeness policy shared by every
+    listing: a token bucket of `rate` requests per second (bursts of `burst`),
+    plus up to `jitter` seconds of random delay per request, however many
+    threads fetch reviews through it (e.g. deferred enrichment, see
+    apt_detail.ApartmentPage).
+    Feature ids are looked up in `fid_cache` (a FidCache) before searching
+    Google for them. With a `checkpoint` (a checkpoint.Checkpoint) every
+    review page is recorded as it arrives, and fetching the reviews of a
+    listing again resumes after the last page recorded. With a
+    `review_store` (a reviewstore.ReviewStore) only the reviews newer than
+    the stored ones are fetched, and the new ones are stored and indexed."""
+
+    def __init__(self, rate=0.5, burst=2, jitter=0.0, fid_cache=None, checkpoint=None, review_store=None):
+        self.bucket = TokenBucket(rate, burst)
+        self.fid_cache = fid_cache
+        self.checkpoint = checkpoint
+        self.review_store = review_store
+        self.jitter = jitter
+
+    def _wait(self):
+        with metrics.timer('review.throttle'):
+            self.bucket.acquire()
+            if self.jitter:
+                time.sleep(random.uniform(0, self.jitter))
+
+    def feature_id(self, keyword):
+        if self.fid_cache is not None:
+            hit, fid = self.fid_cache.lookup(keyword)
+            metrics.count('fid_cache', result='hit' if hit else 'miss')
+            if hit:
+                return fid
+        self._wait()
+        with metrics.timer('review.feature_id'):
+            fid = google.extract_feature_id(google.search(keyword))
+        if fid is None:
+            metrics.count('review_no_fid')
+        if self.fid_cache is not None:
+            self.fid_cache.set(keyword, fid)
+        return fid
+
+    def fetch(self, fid, known=None, sort_by='newestFirst'):
+        """Fetch every review page of `fid`. With `known` (a set of
+        review_key()s) and sort_by='newestFirst', stop at the first review
+        we already have and return only the newer ones."""
+        if known is not None and sort_by != 'newestFirst':
+            raise ValueError('Incremental fetching needs sort_by=newestFirst')
+        stored = self.checkpoint.review_pages(fid, sort_by) if self.checkpoint is not None else []
+        all_reviews = []
+        next_page = ''
+        page = 0
+        while True:
+            if page < len(stored):
+                reviews, next_page = stored[page]
+            else:
+                self._wait()
+                with metrics.timer('review.load_comments'):
+                    reviews, next_page = google.load_comments(fid,
+                            sort_by=sort_by, next_page_token=next_page)
+                metrics.count('review_pages')
+                metrics.count('reviews', len(reviews))
+                if self.checkpoint is not None:
+                    self.checkpoint.add_review_page(fid, sort_by, page, reviews, next_page)
+            page += 1
+            for r in reviews:
+                if known is not None and review_key(r) in known:
+                    return self._fetched(fid, sort_by, all_reviews)
+                all_reviews.append(r)
+            if not next_page:
+                return self._fetched(fid, sort_by, all_reviews)
+
+    def _fetched(self, fid, sort_by, all_reviews):
+        if self.checkpoint is not None:
+            self.checkpoint.reviews_done(fid, sort_by)
+        return all_reviews
+
+    def fetch_keyword(self, keyword, known=None, url=None):
+        """Reviews of the property found by searching Google for `keyword`,
+        see fetch(). With a review store, reviews it has are not fetched
+        again: unless `known` is given the stored ones are returned after the
+        new ones. `url` is the listing to link to the reviews in the store."""
+        fid = self.feature_id(keyword)
+        if fid is None:
+            return []
+        store = self.review_store
+        if store is None:
+            return self.fetch(fid, known=known)
+        if url is not None:
+            store.link(url, fid)
+        stored = store.review_keys(fid)
+        fetched = self.fetch(fid, known=stored | known if known is not None else stored)
+        store.add(fid, fetched)
+        if known is not None:
+            return fetched
+        new = set(review_key(r) for r in fetched)
+        return fetched + [r for r in store.reviews(fid) if review_key(r) not in new]
+
+_default_fetcher = None
+_default_lock = threading.Lock()
+
+
+def default_fetcher():
+    global _default_fetcher
+    with _default_lock:
+        if _default_fetcher is None:
+            _default_fetcher = ReviewFetcher(fid_cache=FidCache())
+        return _default_fetcher
+
+
+def configure(**kwargs):
+    """Replace the shared ReviewFetcher, e.g. configure(rate=1, burst=4).
+    It uses the persistent FidCache unless given fid_cache=None."""
+    global _default_fetcher
+    kwargs.setdefault('fid_cache', FidCache())
+    with _default_lock:
+        _default_fetcher = ReviewFetcher(**kwargs)
+        return _default_fetcher
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+
+from common import data_dir
+from datetime import date, timedelta
+from html import unescape
+
+import getopt
+import hashlib
+import os
+import parsing
+import re
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+_tag = re.compile(r'<[^>]*>')
+_word = re.compile(r'\w+')
+
+
+def review_text(html):
+    """Plain text of a review's full_html."""
+    return unescape(_tag.sub(' ', html))
+
+
+def terms(text):
+    """Distinct index terms of a text: lower case words of two characters
+    or more."""
+    return set(word for word in _word.findall(text.lower()) if len(word) > 1)
+
+
+def relative_date(day, today=None):
+    """Google's way of telling how long ago `day` was, e.g. "3 weeks ago"."""
+    if today is None:
+        today = date.today()
+    days = (today - day).days
+    for unit, length in (('year', 365), ('month', 30), ('week', 7), ('day', 1)):
+        if days >= length:
+            n = days // length
+            return ('a %s ago' % unit) if n == 1 else ('%d %ss ago' % (n, unit))
+    return 'today'
+
+
+class ReviewStore():
+    """SQLite store of Google reviews per feature id (fid), each review kept
+    once, with an inverted index of the words of every review.
+
+    A review is identified by its fid, author and publish date. Google only
+    gives the date relative to the day it was fetched ("2 months ago"), which
+    is turned into a day when the review is first seen; a review whose date
+    reads differently later is still recognized by its text. The text is
+    stored zlib compressed, and indexed as it is added, so searching
+    thousands of properties reads only the postings of the words searched.
+
+    Listings are linked to the fid of their reviews with link()."""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(data_dir(), 'reviews.sqlite')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY, fid TEXT, author TEXT, published TEXT, rating INTEGER,
+            translated INTEGER, thumbs_up_count INTEGER, digest BLOB, text BLOB, first_seen REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS reviews_author ON reviews (fid, author)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS reviews_published ON reviews (published)')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS postings (
+            term TEXT, review INTEGER, PRIMARY KEY (term, review)) WITHOUT ROWID''')
+        self.db.execute('CREATE TABLE IF NOT EXISTS listings (url TEXT PRIMARY KEY, fid TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS listings_fid ON listings (fid)')
+        self.db.commit()
+
+    def link(self, url, fid):
+        """Record that the listing at `url` has the reviews of `fid`."""
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?)', (url, fid))
+            self.db.commit()
+
+    def add(self, fid, reviews, today=None):
+        """Add raw Google reviews (see google.parse_comments) or filtered
+        ones (see ApartmentPage._filter_reviews) of `fid`, skipping the ones
+        already stored. Returns how many were new."""
+        added = 0
+        now = time.time()
+        with self.lock:
+            for r in reviews:
+                if 'review_text' not in r:
+                    continue
+                author = r.get('author_real_name', r.get('author'))
+                html = r['review_text']['full_html']
+                published = parsing.published_date(r['publish_date'].get('localized_date'), today)
+                published = published.isoformat() if published is not None else None
+                rating = r['star_rating']['value'] if 'star_rating' in r else r.get('rating')
+                thumbs = r.get('thumbs_up_count', 0)
+                digest = hashlib.sha1(html.encode('utf-8')).digest()
+                row = self.db.execute('''SELECT id, digest FROM reviews WHERE fid = ? AND author = ?
+                    AND (digest = ? OR published = ?)''', (fid, author, digest, published)).fetchone()
+                if row is not None:
+                    review_id = row[0]
+                    if row[1] == digest:
+                        self.db.execute('UPDATE reviews SET thumbs_up_count = ? WHERE id = ?',
+                            (thumbs, review_id))
+                        continue
+                    # Edited by its author: same review, new text
+                    self.db.execute('''UPDATE reviews SET rating = ?, translated = ?, thumbs_up_count = ?,
+                        digest = ?, text = ? WHERE id = ?''', (rating, r.get('translated', False), thumbs,
+                        digest, zlib.compress(html.encode('utf-8'), 9), review_id))
+                    self.db.execute('DELETE FROM postings WHERE review = ?', (review_id,))
+                else:
+                    review_id = self.db.execute('''INSERT INTO reviews (fid, author, published, rating,
+                        translated, thumbs_up_count, digest, text, first_seen)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                        (fid, author, published, rating, r.get('translated', False), thumbs, digest,
+                        zlib.compress(html.encode('utf-8'), 9), now)).lastrowid
+                    added += 1
+                self.db.executemany('INSERT OR IGNORE INTO postings VALUES (?, ?)',
+                    [(term, review_id) for term in terms(review_text(html))])
+            self.db.commit()
+        return added
+
+    def review_keys(self, fid):
+        """reviews.review_key() of every review of `fid`."""
+        with self.lock:
+            rows = self.db.execute('SELECT author, text FROM reviews WHERE fid = ?', (fid,)).fetchall()
+        return set((author, zlib.decompress(text).decode('utf-8')) for author, text in rows)
+
+    def reviews(self, fid, today=None):
+        """Every review of `fid`, newest first, as raw Google reviews with
+        their relative date as of `today`."""
+        with self.lock:
+            rows = self.db.execute('''SELECT author, published, rating, translated, thumbs_up_count, text
+                FROM reviews WHERE fid = ? ORDER BY published DESC, id''', (fid,)).fetchall()
+        return [{
+            'author_real_name': author,
+            'publish_date': {'localized_date': relative_date(date.fromisoformat(published), today)
+                if published is not None else ''},
+            'review_text': {'full_html': zlib.decompress(text).decode('utf-8')},
+            'star_rating': {'value': rating},
+            'translated': bool(translated),
+            'thumbs_up_count': thumbs
+        } for author, published, rating, translated, thumbs, text in rows]
+
+    def _matches(self, term, since):
+        """Ids of the reviews containing `term` (a prefix if it ends with
+        '*'), published on or after `since`."""
+        term = term.lower()
+        if term.endswith('*'):
+            prefix = term[:-1]
+            cond, params = 'p.term >= ? AND p.term < ?', [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        else:
+            cond, params = 'p.term = ?', [term]
+        query = 'SELECT p.review FROM postings p'
+        if since is not None:
+            query += ' JOIN reviews r ON r.id = p.review'
+            cond += ' AND r.published >= ?'
+            params.append(since.isoformat())
+        return set(row[0] for row in self.db.execute('%s WHERE %s' % (query, cond), params))
+
+    def search(self, words, since=None, match='any'):
+        """Reviews mentioning any (or with match='all', every one) of
+        `words`, published on or after `since` (a date, or a number of days
+        back from today). A word ending with '*' matches every word it
+        starts. Returns dicts with 'id', 'fid', 'author', 'published',
+        'rating' and 'text', newest first."""
+        if isinstance(since, (int, float)):
+            since = date.today() - timedelta(days=since)
+        words = [w for w in words if w.strip('*')]
+        if not words:
+            return []
+        with self.lock:
+            found = None
+            for word in words:
+                ids = self._matches(word, since)
+                if found is None:
+                    found = ids
+                elif match == 'all':
+                    found &= ids
+                else:
+                    found |= ids
+            rows = []
+            found = sorted(found)
+            # SQLite limits the number of parameters of a statement
+            for i in range(0, len(found), 500):
+                chunk = found[i:i + 500]
+                rows.extend(self.db.execute('''SELECT id, fid, author, published, rating, text FROM reviews
+                    WHERE id IN (%s)''' % ','.join('?' * len(chunk)), chunk).fetchall())
+        rows.sort(key=lambda row: (row[3] or '', row[0]), reverse=True)
+        return [{
+            'id': review_id,
+            'fid': fid,
+            'author': author,
+            'published': published,
+            'rating': rating,
+            'text': review_text(zlib.decompress(text).decode('utf-8'))
+        } for review_id, fid, author, published, rating, text in rows]
+
+    def listings(self, words, since=None, match='any'):
+        """Listings whose reviews mention `words` (see search()): a list of
+        {'fid', 'urls', 'reviews'}, the listings with the most matching
+        reviews first."""
+        by_fid = {}
+        for review in self.search(words, since, match):
+            by_fid.setdefault(review['fid'], []).append(review)
+        with self.lock:
+            urls = {}
+            for url, fid in self.db.execute('SELECT url, fid FROM listings'):
+                if fid in by_fid:
+                    urls.setdefault(fid, []).append(url)
+        return sorted(({'fid': fid, 'urls': sorted(urls.get(fid, [])), 'reviews': found}
+            for fid, found in by_fid.items()), key=lambda item: -len(item['reviews']))
+
+    def size(self):
+        """(reviews, bytes of compressed text, postings)"""
+        with self.lock:
+            reviews = self.db.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(text)), 0) FROM reviews').fetchone()
+            return reviews + self.db.execute('SELECT COUNT(*) FROM postings').fetchone()
+
+
+def help():
+    print('Usage: %s [options] <word>...' % sys.argv[0])
+    print('')
+    print('Lists the listings whose Google reviews mention any of the words; "nois*" matches')
+    print('every word starting with "nois".')
+    print('')
+    print('Options:')
+    print('  --since <days | YYYY-MM-DD>: Only reviews published since then')
+    print('  --all: Only reviews mentioning every word')
+    print('  -v: Also print the matching reviews')
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hv', ['since=', 'all'])
+    except getopt.GetoptError as e:
+        print(e)
+        help()
+        exit(1)
+
+    since = None
+    match = 'any'
+    verbose = False
+    for k, v in opts:
+        if k == '--since':
+            since = int(v) if v.isdigit() else date.fromisoformat(v)
+        elif k == '--all':
+            match = 'all'
+        elif k == '-v':
+            verbose = True
+        elif k == '-h':
+            help()
+            exit(0)
+    if not args:
+        help()
+        exit(1)
+
+    for item in ReviewStore().listings(args, since, match):
+        print('%d reviews: %s' % (len(item['reviews']), ' '.join(item['urls']) or item['fid']))
+        if verbose:
+            for review in item['reviews']:
+                print('  %s %s (%s): %s' % (review['published'], review['author'], review['rating'],
+                    review['text'][:200]))
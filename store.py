@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+from common import data_dir
+
+import getopt
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+def page_hash(body):
+    """body: the raw page, bytes or str"""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    return hashlib.sha256(body).hexdigest()
+
+
+def listing_units(apt):
+    """Map (floorplan name, unit name) to the unit dict for every unit listed
+    in `apt`."""
+    units = {}
+    for model in apt.get('floorplans', []):
+        for unit in model['units']:
+            units[(model['name'], unit['unit'])] = unit
+    return units
+
+
+def diff_units(old_apt, new_apt):
+    """List the unit level changes between two versions of a listing: units
+    added or removed, price changes and `date_available` shifts."""
+    old_units = listing_units(old_apt)
+    new_units = listing_units(new_apt)
+    changes = []
+    for key, unit in new_units.items():
+        if key not in old_units:
+            changes.append({'floorplan': key[0], 'unit': key[1], 'kind': 'added',
+                'old': None, 'new': unit['price']})
+            continue
+        old = old_units[key]
+        for field, kind in (('price', 'price'), ('date_available', 'date_available')):
+            if old[field] != unit[field]:
+                changes.append({'floorplan': key[0], 'unit': key[1], 'kind': kind,
+                    'old': old[field], 'new': unit[field]})
+    for key, unit in old_units.items():
+        if key not in new_units:
+            changes.append({'floorplan': key[0], 'unit': key[1], 'kind': 'removed',
+                'old': unit['price'], 'new': None})
+    return changes
+
+
+class ListingStore():
+    """SQLite store of parsed listings (`ApartmentPage.apt`) keyed by listing
+    URL, with the hash of the page they were parsed from and a history of
+    unit changes."""
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(data_dir(), 'listings.sqlite')
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS listings (
+            url TEXT PRIMARY KEY, content_hash TEXT, apt TEXT,
+            first_seen REAL, updated REAL, checked REAL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS unit_changes (
+            url TEXT, floorplan TEXT, unit TEXT, kind TEXT,
+            old TEXT, new TEXT, at REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS unit_changes_url ON unit_changes (url, at)')
+        self.db.commit()
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT apt FROM listings WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def get_unchanged(self, url, content_hash):
+        """Return the stored listing if it was parsed from a page with the same
+        hash, None if the page is new or changed."""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT apt FROM listings WHERE url = ? AND content_hash = ?',
+                (url, content_hash)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE listings SET checked = ? WHERE url = ?', (now, url))
+            self.db.commit()
+        return json.loads(row[0])
+
+    def save(self, url, content_hash, apt):
+        """Store a freshly parsed listing and return its unit changes since the
+        previous version (empty for a new listing)."""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT apt, first_seen FROM listings WHERE url = ?', (url,)).fetchone()
+            if row is None:
+                changes = []
+                first_seen = now
+            else:
+                changes = diff_units(json.loads(row[0]), apt)
+                first_seen = row[1]
+            self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?, ?)',
+                (url, content_hash, json.dumps(apt), first_seen, now, now))
+            self.db.executemany('INSERT INTO unit_changes VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                (url, c['floorplan'], c['unit'], c['kind'], json.dumps(c['old']), json.dumps(c['new']), now)
+                for c in changes])
+            self.db.commit()
+        return changes
+
+    def history(self, url, unit=None):
+        """Unit changes of a listing, oldest first, optionally for one unit."""
+        query = 'SELECT floorplan, unit, kind, old, new, at FROM unit_changes WHERE url = ?'
+        params = [url]
+        if unit is not None:
+            query += ' AND unit = ?'
+            params.append(unit)
+        with self.lock:
+            rows = self.db.execute(query + ' ORDER BY at', params).fetchall()
+        return [{
+            'floorplan': r[0],
+            'unit': r[1],
+            'kind': r[2],
+            'old': json.loads(r[3]),
+            'new': json.loads(r[4]),
+            'at': r[5]
+        } for r in rows]
+
+    def urls(self):
+        with self.lock:
+            return [r[0] for r in self.db.execute('SELECT url FROM listings')]
+
+
+def help():
+    print('Usage: %s [options] <listing url>' % sys.argv[0])
+    print('')
+    print('Prints the unit price and availability history of a stored listing.')
+
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h')
+    except getopt.GetoptError as e:
+        print(e)
+        help()
+        exit(1)
+
+    for k, v in opts:
+        if k == '-h':
+            help()
+            exit(0)
+    if len(args) != 1:
+        help()
+        exit(1)
+
+    for change in ListingStore().history(args[0]):
+        print('%s  %s / %s: %s %s -> %s' % (
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(change['at'])),
+            change['floorplan'], change['unit'], change['kind'], change['old'], change['new']))
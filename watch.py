@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+from apartments import search_all
+from crawler import crawl
+from store import diff_units
+
+import itertools
+import json
+import metrics
+import sys
+import time
+
+
+def _stable(listing):
+    """A listing without the fields that change with the day it is read
+    rather than with the listing: the 'available_on' date of units ("Now"
+    is the day of the crawl) and the relative 'publish_date' of reviews
+    ("2 weeks ago")."""
+    if 'floorplans' not in listing and 'reviews' not in listing:
+        return listing
+    listing = dict(listing)
+    if 'floorplans' in listing:
+        listing['floorplans'] = [dict(model, units=[dict((k, v) for k, v in unit.items() if k != 'available_on')
+            for unit in model.get('units', ())]) for model in listing['floorplans']]
+    if listing.get('reviews'):
+        listing['reviews'] = [dict((k, v) for k, v in review.items() if k != 'publish_date')
+            for review in listing['reviews']]
+    return listing
+
+
+class Watcher():
+    """Re-runs a set of searches, and re-fetches a set of listings, every
+    `interval` seconds in one long-running process, and reports the listings
+    that are new or changed since the previous round as events:
+
+        {"event": "new" | "changed", "time": ..., "url": ..., "listing": {...}}
+
+    Without `details` the listing is the search summary (see
+    apartments.search_results); with it, the parsed detail page (see
+    crawler.crawl), and changed listings have their unit "changes" (see
+    store.diff_units). The first round reports every listing as new, unless
+    `store` (a store.ListingStore) already has it.
+
+    queries: (location, criteria) pairs, see apartments.search_all().
+    urls: listing URLs to watch besides the ones found by searching.
+    crawl_options: passed to crawler.crawl(), e.g. max_workers or rate."""
+
+    def __init__(self, queries=(), urls=(), interval=900, max_pages=1, details=False, store=None,
+            enrich=('reviews',), **crawl_options):
+        self.queries = list(queries)
+        self.urls = list(urls)
+        self.interval = interval
+        self.max_pages = max_pages
+        self.details = details
+        self.store = store
+        self.enrich = enrich
+        self.crawl_options = crawl_options
+        # url -> last summary or record seen, as it reads back from JSON
+        self.listings = {}
+        self.rounds = 0
+
+    def summaries(self):
+        found = search_all(self.queries, max_pages=self.max_pages) if self.queries else ()
+        return itertools.chain(found, ({'url': url} for url in self.urls))
+
+    def _known(self, summaries):
+        # The record the store has of a listing must be read before crawling
+        # it overwrites it
+        for summary in summaries:
+            url = summary['url']
+            if url not in self.listings and self.store is not None:
+                previous = self.store.get(url)
+                if previous is not None:
+                    self.listings[url] = previous
+            yield summary
+
+    def _event(self, url, listing):
+        listing = json.loads(json.dumps(listing))
+        previous = self.listings.get(url)
+        self.listings[url] = listing
+        if previous is not None and _stable(previous) == _stable(listing):
+            return None
+        event = {
+            'event': 'new' if previous is None else 'changed',
+            'time': time.time(),
+            'url': url,
+            'listing': listing
+        }
+        if self.details and previous is not None:
+            event['changes'] = diff_units(previous, listing)
+        metrics.count('watch_events', event=event['event'])
+        return event
+
+    def run_once(self):
+        """Run one round, yielding the event of every new or changed listing
+        as soon as it is known."""
+        self.rounds += 1
+        with metrics.timer('watch.round'):
+            if not self.details:
+                for summary in self.summaries():
+                    event = self._event(summary['url'], summary)
+                    if event is not None:
+                        yield event
+                return
+            for page in crawl(self._known(self.summaries()), store=self.store, enrich=self.enrich,
+                    **self.crawl_options):
+                event = self._event(page.apt['url'], page.apt)
+                if event is not None:
+                    yield event
+
+    def run(self, rounds=None):
+        """Run a round every `interval` seconds (from the start of one to
+        the start of the next), `rounds` times or forever. A round that fails
+        is reported on stderr and the next one runs as planned."""
+        while rounds is None or self.rounds < rounds:
+            start = time.monotonic()
+            try:
+                yield from self.run_once()
+            except Exception as e:
+                metrics.count('failures', stage='watch')
+                print('Watch round %d failed: %r' % (self.rounds, e), file=sys.stderr)
+            if rounds is not None and self.rounds >= rounds:
+                return
+            time.sleep(max(0.0, start + self.interval - time.monotonic()))
+
+
+def write_ndjson(items, out=sys.stdout):
+    """Write each item as one line of JSON as soon as it comes."""
+    for item in items:
+        out.write(json.dumps(item) + '\n')
+        out.flush()